@@ -1,5 +1,5 @@
 """Queries for filesystem data in elasticsearch."""
-import copy
+import functools
 import typing
 
 import elasticsearch_dsl as esd
@@ -7,35 +7,90 @@ import elasticsearch_dsl as esd
 from .. import constants
 
 # Pull in the possible categories for different types of bucket.
-HEAT_BUCKETS = [x["key"] for x in constants.TIME_BUCKETS]
-SIZE_BUCKETS = [x["key"] for x in constants.SIZE_BUCKETS]
+HEAT_BUCKETS = constants.HEAT_KEYS
+SIZE_BUCKETS = constants.SIZE_KEYS
+
+# Note that the content of this script is NOT PYTHON.
+# It is painless (ha!), elasticsearch's own scripting language.
+# .join().split() shennaigans are to strip the newlines, done once here on import.
+_AGG_PARENT_SCRIPT = " ".join(
+    """
+    def path = doc['path'].value; /* The path of the file. */
+    def prefix = params['path']; /* The prefix we are looking for. */
+    if (path != null) {
+        /* Check file is in the path we are interested in */
+        if (path.startsWith(prefix)) {
+            /* Strip the prefix */
+            def trailing = path.substring(prefix.length());
+            if (trailing.length() > 0) {
+                /* The first part of the remainder is the parent
+                that we are interested in */
+                def toplevel = trailing.splitOnToken('/')[1];
+                emit(toplevel);
+            }
+        }
+    }
+""".split()
+)
+
 
+@functools.lru_cache(maxsize=32)
+def _get_mapping(index: str, mapping_name: str) -> typing.Tuple[str, ...]:
+    """Query the real categories currently in a mapping.
 
-def _get_mapping(index: str, mapping_name: str) -> typing.Any:
-    """Query the real categories currently in a mapping."""
+    Results are cached, call clear_mapping_cache() if the mapping may have changed.
+    """
     active_index = esd.Index(index)
     mapping = active_index.get_mapping()
     mappinglist = mapping[list(mapping.keys())[0]]["mappings"]["properties"]
-    return mappinglist[mapping_name]["properties"].keys()
+    return tuple(mappinglist[mapping_name]["properties"].keys())
+
+
+def clear_mapping_cache() -> None:
+    """Forget cached mappings, so that categories added by a new scan are picked up."""
+    _get_mapping.cache_clear()
+
+
+def _aggregation_search(index: str) -> esd.Search:
+    """Create a search which only returns aggregations.
+
+    Aggregation-only (size=0) requests can be served from the shard request cache.
+    Results for a scan_id only change while that scan is being written, so once it
+    is complete repeat queries are answered from the cache until the next refresh.
+    Preferring the local shard copies keeps repeat queries hitting the same cache.
+    """
+    return esd.Search(index=index).extra(size=0).params(request_cache=True, preference="_local")
+
+
+def _path_filter(path: str, scan_id: str) -> typing.Any:
+    """Filter to only the path tree AND the scanner run we are looking at."""
+    return esd.A(
+        "filter",
+        bool={
+            "must": [
+                {"term": {"path.tree": path.rstrip("/")}},
+                {"term": {"scan_id": scan_id}},
+            ]
+        },
+    )
 
 
 def _list_tree_above(path: str) -> typing.List[str]:
     """For a given path, let a list of all paths above it in the tree."""
-    subpaths: list[str] = []
-    for part in path.strip("/").split("/"):
-        if len(subpaths) == 0:
-            subpaths.append("/" + part)
-        else:
-            subpaths.append(subpaths[-1] + "/" + part)
-    return subpaths
+    parts = path.strip("/").split("/")
+    return ["/" + "/".join(parts[: i + 1]) for i in range(len(parts))]
 
 
 def scans(
     path: str,
     index: str,
     sort: typing.Tuple[str, ...] = ("status", "-end_timestamp", "-start_timestamp"),
+    size: typing.Optional[int] = None,
 ) -> typing.Any:
-    """Query the available scans for a file path."""
+    """Query the available scans for a file path.
+
+    If size is given, only that many scans are returned, in a single request.
+    """
     subpaths = _list_tree_above(path)
 
     search = esd.Search(index=index)
@@ -43,14 +98,21 @@ def scans(
     search = search.sort(*sort)
     search = search.extra(track_total_hits=True)
 
-    total = search.count()
-    search = search[0:total]
+    if size is None:
+        # Get the total with a cacheable aggregation-only request, then fetch the hits.
+        size = (
+            search.extra(size=0)
+            .params(request_cache=True, preference="_local")
+            .execute()
+            .hits.total.value
+        )
+    search = search[0:size]
     return search.execute().to_dict()
 
 
 def latest_scan_id(path: str, index: str) -> typing.Optional[str]:
     """Return the newest complete scan for a filepath."""
-    all_scans = scans(path, index)["hits"]["hits"]
+    all_scans = scans(path, index, size=1)["hits"]["hits"]
     if all_scans:
         return typing.cast(str, all_scans[0]["_id"])
     return None
@@ -58,7 +120,7 @@ def latest_scan_id(path: str, index: str) -> typing.Optional[str]:
 
 def latest_scan_info(path: str, index: str) -> typing.Optional[dict[str, typing.Any]]:
     """Return the whole scan object for a filepath."""
-    all_scans = scans(path, index)["hits"]["hits"]
+    all_scans = scans(path, index, size=1)["hits"]["hits"]
     if all_scans:
         result: dict[str, typing.Any] = all_scans[0]["_source"]
         result["id"] = all_scans[0]["_id"]
@@ -66,6 +128,36 @@ def latest_scan_info(path: str, index: str) -> typing.Optional[dict[str, typing.
     return None
 
 
+def latest_scan_info_bulk(
+    paths: typing.List[str], index: str
+) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+    """Return the whole latest scan object for many filepaths in one request.
+
+    Unlike latest_scan_info, only scans of exactly each path are considered, not those of
+    its parents. Paths which have never been scanned are left out.
+    """
+    if not paths:
+        return {}
+
+    search = esd.Search(index=index).extra(size=0)
+    search = search.filter("terms", path=paths)
+    search.aggs.bucket("by_path", "terms", field="path", size=len(paths)).metric(
+        "latest",
+        "top_hits",
+        size=1,
+        sort=[{"status": "asc"}, {"end_timestamp": "desc"}, {"start_timestamp": "desc"}],
+    )
+    response = search.execute().to_dict()  # pylint: disable=no-member
+
+    results = {}
+    for bucket in response["aggregations"]["by_path"]["buckets"]:
+        hit = bucket["latest"]["hits"]["hits"][0]
+        result: dict[str, typing.Any] = hit["_source"]
+        result["id"] = hit["_id"]
+        results[bucket["key"]] = result
+    return results
+
+
 def scan_ids(path: str, index: str) -> typing.Optional[typing.List[str]]:
     """Return all scan_ids for a filepath, not including parent paths."""
     search = esd.Search(index=index)
@@ -80,55 +172,29 @@ def scan_ids(path: str, index: str) -> typing.Optional[typing.List[str]]:
     return None
 
 
+def _agg_parent_mapping(path: str) -> dict[str, typing.Any]:
+    """Runtime mapping labelling paths by their parent directly below `path`."""
+    return {
+        "agg_parent": esd.Keyword(
+            script={
+                "source": _AGG_PARENT_SCRIPT,
+                "params": {"path": path},
+            }
+        )
+    }
+
+
 def children(path: str, index: str, scan_id: str) -> typing.Any:
     """Query all direct children of a path."""
     # We're all about the aggregations.
-    search = esd.Search(index=index).extra(size=0)
+    search = _aggregation_search(index)
 
     # Add field labelling paths by their parent directly below `path`.
-    search = search.extra(
-        runtime_mappings={
-            "agg_parent": esd.Keyword(
-                # Note that the content of source is NOT PYTHON.
-                # It is painless (ha!), elasticsearch's own scripting language.
-                # .join().split() shennaigans are to strip the newlines.
-                script={
-                    "source": " ".join(
-                        """
-                        def path = doc['path'].value; /* The path of the file. */
-                        def prefix = params['path']; /* The prefix we are looking for. */
-                        if (path != null) {
-                            /* Check file is in the path we are interested in */
-                            if (path.startsWith(prefix)) {
-                                /* Strip the prefix */
-                                def trailing = path.substring(prefix.length());
-                                if (trailing.length() > 0) {
-                                    /* The first part of the remainder is the parent
-                                    that we are interested in */
-                                    def toplevel = trailing.splitOnToken('/')[1];
-                                    emit(toplevel);
-                                }
-                            }
-                        }
-                    """.split()
-                    ),
-                    "params": {"path": path},
-                }
-            )
-        }
-    )
+    search = search.extra(runtime_mappings=_agg_parent_mapping(path))
 
     # Filter to only the path tree we are looking at.
     # AND to only the scanner run we are looking at.
-    paths = esd.A(
-        "filter",
-        bool={
-            "must": [
-                {"term": {"path.tree": path.rstrip("/")}},
-                {"term": {"scan_id": scan_id}},
-            ]
-        },
-    )
+    paths = _path_filter(path, scan_id)
 
     # Calculate some information about the top level object.
     paths.metric("size", esd.A("sum", field="size"))
@@ -153,108 +219,99 @@ def children(path: str, index: str, scan_id: str) -> typing.Any:
     return search.execute().to_dict()  # pylint: disable=no-member
 
 
-def hotness(path: str, index: str, scan_id: str) -> typing.Any:
-    """Query the heat statistics for a path."""
+def _hotness_search(path: str, index: str, scan_id: str) -> esd.Search:
+    """Build the search for hotness(), without executing it."""
     # We're all about the aggregations.
-    search = esd.Search(index=index).extra(size=0)
-
-    # Filter to only the path tree we are looking at.
-    # AND to only the scanner run we are looking at.
-    paths = esd.A(
-        "filter",
-        bool={
-            "must": [
-                {"term": {"path.tree": path.rstrip("/")}},
-                {"term": {"scan_id": scan_id}},
-            ]
-        },
-    )
+    search = _aggregation_search(index)
 
-    # Bucket into hotness.
-    counts = copy.deepcopy(paths)
-    sizes = copy.deepcopy(paths)
-    for hot in HEAT_BUCKETS:
-        sizes.metric(f"{hot}", esd.A("sum", field=f"heat_bins.{hot}.size"))
-        counts.metric(f"{hot}", esd.A("sum", field=f"heat_bins.{hot}.count"))
+    # Bucket into hotness, each with a fresh copy of the filter.
+    counts = _path_filter(path, scan_id)
+    sizes = _path_filter(path, scan_id)
+    for hot, size_field, count_field in zip(
+        constants.HEAT_KEYS, constants.HEAT_SIZE_FIELDS, constants.HEAT_COUNT_FIELDS
+    ):
+        sizes.metric(hot, esd.A("sum", field=size_field))
+        counts.metric(hot, esd.A("sum", field=count_field))
 
     search.aggs.bucket("counts", counts)  # pylint: disable=no-member
     search.aggs.bucket("sizes", sizes)  # pylint: disable=no-member
-    return search.execute().to_dict()  # pylint: disable=no-member
+    return search
 
 
-def filetypes(path: str, index: str, scan_id: str) -> typing.Any:
-    """Query filetype statistics for a path."""
-    # We're all about the aggregations.
-    search = esd.Search(index=index).extra(size=0)
+def hotness(path: str, index: str, scan_id: str) -> typing.Any:
+    """Query the heat statistics for a path."""
+    return _hotness_search(path, index, scan_id).execute().to_dict()
 
-    # Filter to only the path tree we are looking at.
-    # AND to only the scanner run we are looking at.
-    paths = esd.A(
-        "filter",
-        bool={
-            "must": [
-                {"term": {"path.tree": path.rstrip("/")}},
-                {"term": {"scan_id": scan_id}},
-            ]
-        },
-    )
 
-    # Bucket into filetypes.
-    counts = copy.deepcopy(paths)
-    sizes = copy.deepcopy(paths)
+def _filetypes_search(path: str, index: str, scan_id: str) -> esd.Search:
+    """Build the search for filetypes(), without executing it."""
+    # We're all about the aggregations.
+    search = _aggregation_search(index)
+
+    # Bucket into filetypes, each with a fresh copy of the filter.
+    counts = _path_filter(path, scan_id)
+    sizes = _path_filter(path, scan_id)
     for type_ in _get_mapping(index, "filetypes"):
         sizes.metric(f"{type_}", esd.A("sum", field=f"filetypes.{type_}.size"))
         counts.metric(f"{type_}", esd.A("sum", field=f"filetypes.{type_}.count"))
 
     search.aggs.bucket("counts", counts)  # pylint: disable=no-member
     search.aggs.bucket("sizes", sizes)  # pylint: disable=no-member
-    return search.execute().to_dict()  # pylint: disable=no-member
+    return search
 
 
-def users(path: str, index: str, scan_id: str) -> typing.Any:
-    """Query statics for users associated with a filepath."""
+def filetypes(path: str, index: str, scan_id: str) -> typing.Any:
+    """Query filetype statistics for a path."""
+    return _filetypes_search(path, index, scan_id).execute().to_dict()
+
+
+def _users_search(path: str, index: str, scan_id: str) -> esd.Search:
+    """Build the search for users(), without executing it."""
     # We're all about the aggregations.
-    search = esd.Search(index=index).extra(size=0)
+    search = _aggregation_search(index)
 
-    # Filter to only the path tree we are looking at.
-    # AND to only the scanner run we are looking at.
-    paths = esd.A(
-        "filter",
-        bool={
-            "must": [
-                {"term": {"path.tree": path.rstrip("/")}},
-                {"term": {"scan_id": scan_id}},
-            ]
-        },
-    )
-    # Bucket into users.
-    counts = copy.deepcopy(paths)
-    sizes = copy.deepcopy(paths)
+    # Bucket into users, each with a fresh copy of the filter.
+    counts = _path_filter(path, scan_id)
+    sizes = _path_filter(path, scan_id)
     for user in _get_mapping(index, "users"):
         sizes.metric(f"{user}", esd.A("sum", field=f"users.{user}.size"))
         counts.metric(f"{user}", esd.A("sum", field=f"users.{user}.count"))
 
     search.aggs.bucket("counts", counts)  # pylint: disable=no-member
     search.aggs.bucket("sizes", sizes)  # pylint: disable=no-member
-    return search.execute().to_dict()  # pylint: disable=no-member
+    return search
+
+
+def users(path: str, index: str, scan_id: str) -> typing.Any:
+    """Query statics for users associated with a filepath."""
+    return _users_search(path, index, scan_id).execute().to_dict()
+
+
+def multi_aggregate(path: str, index: str, scan_id: str) -> dict[str, typing.Any]:
+    """Query filetype, user and heat statistics for a path in a single request."""
+    # Only the aggregations are needed, so have elasticsearch leave everything else out.
+    msearch = esd.MultiSearch(index=index).params(
+        filter_path="responses.aggregations,responses.error"
+    )
+    msearch = msearch.add(_filetypes_search(path, index, scan_id))
+    msearch = msearch.add(_users_search(path, index, scan_id))
+    msearch = msearch.add(_hotness_search(path, index, scan_id))
+    filetypes_r, users_r, heat_r = msearch.execute()
+    return {
+        "filetypes": filetypes_r.to_dict(),
+        "users": users_r.to_dict(),
+        "heat_bins": heat_r.to_dict(),
+    }
 
 
 def count_size(path: str, index: str, scan_id: str) -> typing.Any:
     """Query basic size and count of a filepath."""
     # We're all about the aggregations.
-    search = esd.Search(index=index).extra(size=0)
+    search = _aggregation_search(index)
 
     # Filter to only the path tree we are looking at.
     # AND to only the scanner run we are looking at.
-    paths = esd.A(
-        "filter",
-        bool={
-            "must": [
-                {"term": {"path.tree": path.rstrip("/")}},
-                {"term": {"scan_id": scan_id}},
-            ]
-        },
-    )
+    paths = _path_filter(path, scan_id)
 
     paths.metric("size", esd.A("sum", field="size"))
     paths.metric("count", esd.A("sum", field="count"))
@@ -263,12 +320,35 @@ def count_size(path: str, index: str, scan_id: str) -> typing.Any:
     return search.execute().to_dict()  # pylint: disable=no-member
 
 
-def children_records(path: str, index: str, scan_id: str) -> typing.Any:
-    """Query all direct children of a path."""
-    # We're all about the aggregations.
-    search = esd.Search(index=index).extra(size=10000)
+def children_records(
+    path: str, index: str, scan_id: str, page_size: int = 1000
+) -> typing.Iterator[typing.Any]:
+    """Iterate over the records for everything below a path.
 
+    Results are paged through with a point in time, so there is no limit on how many are
+    returned and only one page is held in memory at a time.
+    """
+    conn = esd.connections.get_connection()
+    pit_id = conn.open_point_in_time(index=index, keep_alive="1m")["id"]
+
+    search = esd.Search().extra(size=page_size)
     search = search.filter("term", path__tree=path.rstrip("/"))
     search = search.filter("term", scan_id=scan_id)
-
-    return search.execute().to_dict()  # pylint: disable=no-member
+    search = search.sort("_shard_doc")
+
+    try:
+        search_after = None
+        while True:
+            page = search.extra(pit={"id": pit_id, "keep_alive": "1m"})
+            if search_after is not None:
+                page = page.extra(search_after=search_after)
+            response = conn.search(body=page.to_dict())
+            hits = response["hits"]["hits"]
+            if not hits:
+                break
+            yield from hits
+            # The point in time id can change between requests.
+            pit_id = response.get("pit_id", pit_id)
+            search_after = hits[-1]["sort"]
+    finally:
+        conn.close_point_in_time(body={"id": pit_id})
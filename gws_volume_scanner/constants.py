@@ -37,7 +37,13 @@ TIME_BUCKETS: typing.List[TimeBucket] = [
     {"key": "5y-*", "from": dt.timedelta(days=1825)},
 ]
 
-DEFAULT_LOGGING_CONFIG = {
+# Names of the bins, and the fields in elasticsearch holding their totals.
+HEAT_KEYS: typing.Tuple[str, ...] = tuple(x["key"] for x in TIME_BUCKETS)
+HEAT_SIZE_FIELDS: typing.Tuple[str, ...] = tuple(f"heat_bins.{k}.size" for k in HEAT_KEYS)
+HEAT_COUNT_FIELDS: typing.Tuple[str, ...] = tuple(f"heat_bins.{k}.count" for k in HEAT_KEYS)
+SIZE_KEYS: typing.Tuple[str, ...] = tuple(x["key"] for x in SIZE_BUCKETS)
+
+DEFAULT_LOGGING_CONFIG: dict[str, typing.Any] = {
     "version": 1,
     "root": {"level": "INFO", "handlers": ["console"]},
     "handlers": {"console": {"class": "logging.StreamHandler"}},
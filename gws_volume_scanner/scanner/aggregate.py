@@ -1,71 +1,59 @@
+import itertools
+import typing
+
 from ..client import queries
 from . import config, models
 
 
-def aggregate_filetypes(
+def aggregate(
     path: str,
     elastic_config: config.ElasticSchema,
     volume_info: models.Volume,
-) -> list[models.GranularRecord]:
-    filetypes = []
-    filetypes_q = queries.filetypes(path, elastic_config["data_index_name"], volume_info.meta.id)
-    for type_ in filetypes_q["aggregations"]["counts"].keys():
-        if type_ != "doc_count" and (filetypes_q["aggregations"]["counts"][type_]["value"] > 0):
-            record = models.GranularRecord(
-                path=path,
-                scan_id=volume_info.meta.id,
-                category="filetypes",
-                identifier=type_,
-                size=filetypes_q["aggregations"]["sizes"][type_]["value"],
-                count=filetypes_q["aggregations"]["counts"][type_]["value"],
-                start_timestamp=volume_info.start_timestamp,
-                end_timestamp=volume_info.end_timestamp,
-            )
-            filetypes.append(record.to_dict())
-    return filetypes
+) -> typing.Iterator[dict[str, typing.Any]]:
+    """Query filetype, user and heat statistics for a path and turn them into records.
 
+    The queries are made straight away, but records are only built as they are iterated
+    over, so they can be streamed into a bulk request.
+    """
+    # Don't run the expensive aggregations if there is nothing to aggregate.
+    count_size_q = queries.count_size(path, elastic_config["data_index_name"], volume_info.meta.id)
+    if count_size_q["aggregations"]["count_size"]["count"]["value"] == 0:
+        return iter(())
 
-def aggregate_users(
-    path: str,
-    elastic_config: config.ElasticSchema,
-    volume_info: models.Volume,
-) -> list[models.GranularRecord]:
-    users = []
-    users_q = queries.users(path, elastic_config["data_index_name"], volume_info.meta.id)
-    for user in users_q["aggregations"]["counts"].keys():
-        if user != "doc_count" and (users_q["aggregations"]["counts"][user]["value"] > 0):
-            record = models.GranularRecord(
-                path=path,
-                scan_id=volume_info.meta.id,
-                category="users",
-                identifier=user,
-                size=users_q["aggregations"]["sizes"][user]["value"],
-                count=users_q["aggregations"]["counts"][user]["value"],
-                start_timestamp=volume_info.start_timestamp,
-                end_timestamp=volume_info.end_timestamp,
-            )
-            users.append(record.to_dict())
-    return users
+    results = queries.multi_aggregate(path, elastic_config["data_index_name"], volume_info.meta.id)
+    return itertools.chain.from_iterable(
+        _category_records(path, category, result, volume_info)
+        for category, result in results.items()
+    )
 
 
-def aggregate_heat(
-    path: str,
-    elastic_config: config.ElasticSchema,
-    volume_info: models.Volume,
-) -> list[models.GranularRecord]:
-    heat_bins = []
-    heat_q = queries.hotness(path, elastic_config["data_index_name"], volume_info.meta.id)
-    for hot in heat_q["aggregations"]["counts"].keys():
-        if hot != "doc_count" and (heat_q["aggregations"]["counts"][hot]["value"] > 0):
-            record = models.GranularRecord(
-                path=path,
-                scan_id=volume_info.meta.id,
-                category="heat_bins",
-                identifier=hot,
-                size=heat_q["aggregations"]["sizes"][hot]["value"],
-                count=heat_q["aggregations"]["counts"][hot]["value"],
-                start_timestamp=volume_info.start_timestamp,
-                end_timestamp=volume_info.end_timestamp,
-            )
-            heat_bins.append(record.to_dict())
-    return heat_bins
+def _category_records(
+    path: str, category: str, result: dict[str, typing.Any], volume_info: models.Volume
+) -> typing.Iterator[dict[str, typing.Any]]:
+    """Turn the response to one of the aggregation queries into records."""
+    base = _record_base(path, category, volume_info)
+    counts = result["aggregations"]["counts"]
+    sizes = result["aggregations"]["sizes"]
+    for identifier, count in counts.items():
+        if identifier != "doc_count" and count["value"] > 0:
+            yield base | {
+                "identifier": identifier,
+                "size": sizes[identifier]["value"],
+                "count": count["value"],
+            }
+
+
+def _record_base(path: str, category: str, volume_info: models.Volume) -> dict[str, typing.Any]:
+    """Fields shared by every GranularRecord for a path and category.
+
+    Records are built as plain dicts, which is what GranularRecord.to_dict() would
+    give, without creating a document per bucket. Like to_dict(), empty fields are left out.
+    """
+    base = {
+        "path": path,
+        "scan_id": volume_info.meta.id,
+        "category": category,
+        "start_timestamp": volume_info.start_timestamp,
+        "end_timestamp": volume_info.end_timestamp,
+    }
+    return {key: value for key, value in base.items() if value is not None}
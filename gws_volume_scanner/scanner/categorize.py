@@ -2,6 +2,7 @@
 
 import bisect
 import datetime as dt
+import functools
 import logging
 import mimetypes
 import os
@@ -13,77 +14,122 @@ from .. import constants
 
 logger = logging.getLogger()
 
+# Bin boundaries and names, in ascending order, so they can be bisected.
+_TIME_FROMS = tuple(x["from"] for x in constants.TIME_BUCKETS)
+_TIME_FROM_SECONDS = tuple(x.total_seconds() for x in _TIME_FROMS)
+_TIME_KEYS = constants.HEAT_KEYS
+_SIZE_FROMS = tuple(x["from"] for x in constants.SIZE_BUCKETS)
+_SIZE_KEYS = constants.SIZE_KEYS
+
+# File types which can be told from the type bits of a file's mode alone.
+# Doors, event ports and whiteouts don't exist on every platform, where their
+# constants are 0, so they are left out there.
+_IFMT_TABLE = {
+    ifmt: ftype
+    for ifmt, ftype in (
+        (stat.S_IFDIR, "__directory__"),
+        (stat.S_IFCHR, "__character_device__"),
+        (stat.S_IFBLK, "__block_device__"),
+        (stat.S_IFIFO, "__named_pipe__"),
+        (stat.S_IFLNK, "__symlink__"),
+        (stat.S_IFSOCK, "__socket__"),
+        (stat.S_IFDOOR, "__door__"),
+        (stat.S_IFPORT, "__port__"),
+        (stat.S_IFWHT, "__whiteout__"),
+    )
+    if ifmt
+}
+
+
+def get_time_bin(datetime: dt.datetime, now: typing.Optional[dt.datetime] = None) -> str:
+    """Return the time bin of a file given it's atime.
+
+    The age is measured from now, unless another reference time is passed.
+    """
+    if now is None:
+        now = dt.datetime.now()
+    index = bisect.bisect_left(_TIME_FROMS, now - datetime) - 1
+    if index < 0:
+        logger.warning(
+            "get_time_bin given datatime which is could not categorise because it's in the future."
+        )
+        return _TIME_KEYS[0]
+    return _TIME_KEYS[index]
 
-def get_time_bin(datetime: dt.datetime) -> str:
-    """Return the time bin of a file given it's atime."""
-    values = [dt.datetime.now() - x["from"] for x in reversed(constants.TIME_BUCKETS)]
-    keys = [x["key"] for x in reversed(constants.TIME_BUCKETS)]
-    try:
-        result = str(keys[bisect.bisect_right(values, datetime)])
-    except IndexError:
-        result = constants.TIME_BUCKETS[0]["key"]
+
+def get_time_bin_from_timestamp(atime: float, now: float) -> str:
+    """Return the time bin of a file given it's atime, both as seconds since the epoch.
+
+    This skips converting to datetimes, for use on every file.
+    """
+    index = bisect.bisect_left(_TIME_FROM_SECONDS, now - atime) - 1
+    if index < 0:
         logger.warning(
             "get_time_bin given datatime which is could not categorise because it's in the future."
         )
-    return result
+        return _TIME_KEYS[0]
+    return _TIME_KEYS[index]
 
 
 def get_size_bin(size: int) -> str:
     """Return the size bin of a file given it's size."""
-    values = [x["from"] for x in constants.SIZE_BUCKETS]
-    keys = [x["key"] for x in constants.SIZE_BUCKETS]
-    return str(keys[bisect.bisect_right(values, size)])
+    return _SIZE_KEYS[bisect.bisect_right(_SIZE_FROMS, size)]
+
+
+def get_time_bins(atimes: typing.Iterable[float], now: float) -> list[str]:
+    """Return the time bins of a batch of files given their atimes, as seconds since the epoch."""
+    return [get_time_bin_from_timestamp(atime, now) for atime in atimes]
+
+
+def get_size_bins(sizes: typing.Iterable[int]) -> list[str]:
+    """Return the size bins of a batch of files given their sizes."""
+    bisect_right = bisect.bisect_right
+    return [_SIZE_KEYS[bisect_right(_SIZE_FROMS, size)] for size in sizes]
 
 
 def detect_filetype(path: str, stat_: typing.Optional[os.stat_result] = None) -> str:
     """Given a file path, work out what type the file is."""
-    # pylint: disable=R0912
-    # Pylint complains that this function has too many branches.
-    # I cannot think of a more efficient way of testing for all the
-    # types of file that we need to.
-
     if stat_ is None:
         stat_ = os.lstat(path)
 
-    # If a file is unknown, it mean's its not one of the types in the
-    # big if/else below.
-    ftype = "__unknown__"
-
-    mode = stat_.st_mode
     # If the file type information is contained in it's mode,
     # it is much more accurate and efficient to use that information
     # first.
-    if stat.S_ISDIR(mode):
-        ftype = "__directory__"
-    elif stat.S_ISCHR(mode):
-        ftype = "__character_device__"
-    elif stat.S_ISBLK(mode):
-        ftype = "__block_device__"
-    elif stat.S_ISFIFO(mode):
-        ftype = "__named_pipe__"
-    elif stat.S_ISLNK(mode):
-        ftype = "__symlink__"
-    elif stat.S_ISSOCK(mode):
-        ftype = "__socket__"
-    elif stat.S_ISDOOR(mode):
-        ftype = "__door__"
-    elif stat.S_ISPORT(mode):
-        ftype = "__port__"
-    elif stat.S_ISWHT(mode):
-        ftype = "__whiteout__"
-    elif stat.S_ISREG(mode):
+    ifmt = stat.S_IFMT(stat_.st_mode)
+    ftype = _IFMT_TABLE.get(ifmt)
+    if ftype is not None:
+        return ftype
+    if ifmt == stat.S_IFREG:
         # Otherwise, if the file is a regular file, we can safely guess it's type from
         # it's extension. This does not inspect the file itself, only the path.
-        guess = mimetypes.guess_type(path, strict=False)
-        if guess[0] is None:
-            ftype = "__unknown_file__"
-        else:
-            ftype = guess[0]
+        base, ext = os.path.splitext(path)
+        return _guess_by_ext(os.path.splitext(base)[1] + ext)
+    # If a file is unknown, it mean's its not one of the types in the table.
+    return "__unknown__"
+
+
+@functools.lru_cache(maxsize=4096)
+def _guess_by_ext(ext: str) -> str:
+    """Guess the type of a regular file from the end of its name.
+
+    mimetypes only looks at the last two extensions (eg. ".tar.gz"), so results
+    are cached on those and shared between all files with the same ending.
+    """
+    guess = mimetypes.guess_type(f"file{ext}", strict=False)
+    if guess[0] is None:
+        ftype = "__unknown_file__"
+    else:
+        ftype = guess[0]
     return ftype.replace(".", "__")
 
 
+@functools.lru_cache(maxsize=4096)
 def username_from_uid(uid: int) -> str:
-    """Convert a UID to a username."""
+    """Convert a UID to a username.
+
+    Results are cached as lookups can go over the network, and there are far
+    fewer users than files.
+    """
     try:
         username = pwd.getpwuid(uid).pw_name.replace(".", "__")
     except KeyError:
@@ -91,31 +137,41 @@ def username_from_uid(uid: int) -> str:
     return username
 
 
-def filesystem_info(path: str) -> typing.Dict[str, typing.Any]:
-    """Parse /proc/mounts (which has fstab format) to find out the type of a filesystem."""
-    # Get the data and split into a list of mounts.
+def parse_mounts() -> list[list[str]]:
+    """Parse /proc/mounts (which has fstab format) into a list of mounts.
+
+    Mounts are ordered longest mountpoint first, so the first one which is a prefix of a
+    path is the filesystem the path is on. Where a mountpoint has been mounted over,
+    the most recent mount comes first.
+    """
     with open("/proc/mounts", "r") as f:
-        procmounts_raw = f.read()
-    procmounts = procmounts_raw.strip().split("\n")
+        procmounts = [mnt.split() for mnt in f.read().strip().split("\n")]
+    procmounts.reverse()
+    procmounts.sort(key=lambda items: len(items[1]), reverse=True)
+    return procmounts
+
+
+def filesystem_info(
+    path: str, mounts: typing.Optional[list[list[str]]] = None
+) -> typing.Dict[str, typing.Any]:
+    """Find out the type of the filesystem a path is on.
 
-    # Find all mount points that match our path.
-    possiblemounts = {}
-    for mnt in procmounts:
-        items = mnt.split()
-        if path.startswith(items[1]):
-            possiblemounts[items[1]] = items
+    Mounts are read from /proc/mounts on every call, as automounted filesystems can
+    appear at any time. Callers looking up many paths at once can parse_mounts() once and
+    pass the result in.
+    """
+    if mounts is None:
+        mounts = parse_mounts()
 
     # Find the longest mountpoint that matches our path.
-    if len(possiblemounts) > 0:
-        ordered = sorted(possiblemounts.keys(), key=len, reverse=True)
-        longest_key = ordered[0]
-        longest = possiblemounts[longest_key]
-        return {
-            "fs_spec": longest[0],
-            "fs_file": longest[1],
-            "fs_vfstype": longest[2],
-            "fs_mntops": longest[3],
-            "fs_freq": longest[4],
-            "fs_passno": longest[5],
-        }
+    for longest in mounts:
+        if path.startswith(longest[1]):
+            return {
+                "fs_spec": longest[0],
+                "fs_file": longest[1],
+                "fs_vfstype": longest[2],
+                "fs_mntops": longest[3],
+                "fs_freq": longest[4],
+                "fs_passno": longest[5],
+            }
     raise FileNotFoundError
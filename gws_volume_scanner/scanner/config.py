@@ -3,13 +3,13 @@ import os
 import typing
 
 import tomli
-import typeguard
 
 from . import errors
 
 
 ## The following classes setup the shape of the configuration files.
-## They are used both for type checking AND AT RUNTIME to check if the config is valid.
+## They are used both for type checking AND AT RUNTIME to check if the config is valid,
+## see the validators below.
 class ElasticSchema(typing.TypedDict):
     """Schema for settings for elastic."""
 
@@ -23,6 +23,13 @@ class ElasticSchema(typing.TypedDict):
     timeout: int
     api_key: str
 
+    # How many bulk requests are sent at once, and how many chunks are queued.
+    bulk_thread_count: typing.NotRequired[int]
+    bulk_queue_size: typing.NotRequired[int]
+    # Limits on the number of documents and bytes in each bulk request.
+    bulk_chunk_size: typing.NotRequired[int]
+    bulk_max_chunk_bytes: typing.NotRequired[int]
+
 
 class DaemonSchema(typing.TypedDict):
     """Schema for the scanner daemon."""
@@ -36,6 +43,8 @@ class DaemonSchema(typing.TypedDict):
     services_endpoint: str
 
     max_scan_interval_days: int
+    # How often the list of GWSs is refreshed from the projects portal, in seconds.
+    gws_list_ttl_seconds: typing.NotRequired[int]
 
     extra_to_scan: list[str]
     never_scan: list[str]
@@ -48,8 +57,14 @@ class ScannerSchema(typing.TypedDict):
 
     scan_processes: int
     scan_max_threads_per_process: int
+    # Number of threads listing directories for the queue of directories to scan.
+    scan_walker_threads: typing.NotRequired[int]
 
     queue_length_scale_factor: int
+    # Number of documents each scan process collects before sending them to elasticsearch.
+    elastic_batch_size: typing.NotRequired[int]
+    # Number of processes sending documents to elasticsearch.
+    elastic_workers: typing.NotRequired[int]
 
     daemon: DaemonSchema
     elastic: ElasticSchema
@@ -79,6 +94,72 @@ class MainConfigSchema(typing.TypedDict):
     gws: GWSMainConfigSchema
 
 
+def _compile_validator(
+    type_: typing.Any, name: str = "config"
+) -> typing.Callable[[typing.Any], None]:
+    """Build a function which raises TypeError if a value does not match a schema.
+
+    The schema is walked once here, so checking a config is just a walk of its dicts.
+    Only the types used in the schemas above are supported.
+    """
+    if typing.is_typeddict(type_):
+        fields = {
+            key: _compile_validator(hint, f"{name}.{key}")
+            for key, hint in typing.get_type_hints(type_).items()
+        }
+        required = type_.__required_keys__
+
+        def check_typeddict(value: typing.Any) -> None:
+            if not isinstance(value, dict):
+                raise TypeError(f"{name} is not a table")
+            if missing := required - value.keys():
+                raise TypeError(f"{name} is missing {', '.join(sorted(missing))}")
+            for key, item in value.items():
+                if key not in fields:
+                    raise TypeError(f"{name} has unexpected key {key}")
+                fields[key](item)
+
+        return check_typeddict
+
+    origin = typing.get_origin(type_)
+    if origin is list:
+        check_item = _compile_validator(typing.get_args(type_)[0], f"{name}[]")
+
+        def check_list(value: typing.Any) -> None:
+            if not isinstance(value, list):
+                raise TypeError(f"{name} is not a list")
+            for item in value:
+                check_item(item)
+
+        return check_list
+
+    if origin is dict:
+        check_key = _compile_validator(typing.get_args(type_)[0], f"{name} key")
+        check_value = _compile_validator(typing.get_args(type_)[1], f"{name}[]")
+
+        def check_dict(value: typing.Any) -> None:
+            if not isinstance(value, dict):
+                raise TypeError(f"{name} is not a table")
+            for key, item in value.items():
+                check_key(key)
+                check_value(item)
+
+        return check_dict
+
+    if type_ is typing.Any:
+        return lambda value: None
+
+    def check_instance(value: typing.Any) -> None:
+        if not isinstance(value, type_):
+            raise TypeError(f"{name} is not of type {type_.__name__}")
+
+    return check_instance
+
+
+_check_main_config = _compile_validator(MainConfigSchema)
+_check_gws_config = _compile_validator(GWSConfigSchema)
+
+
 ## This class is the main configuration object for the scanner.
 class ScannerConfig:
     """Object holding the configuration for the GWS Scanner."""
@@ -90,7 +171,7 @@ class ScannerConfig:
 
         # Check that the scanner config is what we expect.
         try:
-            typeguard.check_type(toml_dict, MainConfigSchema)
+            _check_main_config(toml_dict)
         except TypeError as err:
             raise errors.ScannerMainConfigError from err
 
@@ -99,7 +180,16 @@ class ScannerConfig:
             # Required.
             self._scanner_config = toml_dict["scanner"]
             self._gws_defaults = toml_dict["gws"]["defaults"]
-            self._gws_overrides = toml_dict["gws"]["overrides"]
+            # Fill in the overrides which are not set, so they can be applied unconditionally.
+            self._gws_overrides = (
+                GWSConfigSchema(
+                    full_item_walk_dirs=[],
+                    aggregate_subdir_paths=[],
+                    aggregate_subdir_names=[],
+                    scan_depth=100000,
+                )
+                | toml_dict["gws"]["overrides"]
+            )
             # Allowed to be empty.
             self._gws_configs = toml_dict["gws"].get("configs", {})
         except KeyError as err:
@@ -115,41 +205,29 @@ class ScannerConfig:
             with open(configpath, "rb") as thefile:
                 user_dict = typing.cast(GWSConfigSchema, tomli.load(thefile))
             try:
-                typeguard.check_type(user_dict, GWSConfigSchema)
+                _check_gws_config(user_dict)
             except TypeError as err:
                 raise errors.ScannerGWSConfigError from err
 
-        # Combine it with the default.
-        # Mypy does not understand **. When we get 3.9 and can | dicts this will be better.
-        config_dict = typing.cast(GWSConfigSchema, {**self._gws_defaults, **user_dict})
-
-        # Get any config from the admin configuration.
-        config_dict = typing.cast(
-            GWSConfigSchema, {**config_dict, **self._gws_configs.get(path, {})}
-        )
+        # Combine it with the default, then any config from the admin configuration.
+        config_dict = self._gws_defaults | user_dict | self._gws_configs.get(path, {})
 
-        # Apply overrides.
+        # Apply overrides. Lists are deduplicated but keep their order.
+        overrides = self._gws_overrides
         config_dict["full_item_walk_dirs"] = list(
-            set(
-                config_dict["full_item_walk_dirs"]
-                + self._gws_overrides.get("full_item_walk_dirs", [])
-            )
+            dict.fromkeys(config_dict["full_item_walk_dirs"] + overrides["full_item_walk_dirs"])
         )
         config_dict["aggregate_subdir_paths"] = list(
-            set(
-                config_dict["aggregate_subdir_paths"]
-                + self._gws_overrides.get("aggregate_subdir_paths", [])
+            dict.fromkeys(
+                config_dict["aggregate_subdir_paths"] + overrides["aggregate_subdir_paths"]
             )
         )
         config_dict["aggregate_subdir_names"] = list(
-            set(
-                config_dict["aggregate_subdir_names"]
-                + self._gws_overrides.get("aggregate_subdir_names", [])
+            dict.fromkeys(
+                config_dict["aggregate_subdir_names"] + overrides["aggregate_subdir_names"]
             )
         )
-        config_dict["scan_depth"] = min(
-            config_dict["scan_depth"], self._gws_overrides.get("scan_depth", 100000)
-        )
+        config_dict["scan_depth"] = min(config_dict["scan_depth"], overrides["scan_depth"])
         return config_dict
 
     @property
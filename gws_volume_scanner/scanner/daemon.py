@@ -4,17 +4,26 @@ import argparse
 import datetime as dt
 import logging
 import os
-import pathlib
+import queue as queue_
 import random
+import signal
+import stat
+import threading as th
 import time
 import typing
 
 import authlib.integrations.httpx_client
 import httpx
+import orjson
 import sdnotify
 
 from ..client import queries
-from . import cli, config, elastic, errors, scan_single, util
+from . import categorize, cli, config, elastic, errors, scan_single, util
+
+# Watchdog timeout from the unit file, used when systemd doesn't pass it in the environment.
+_DEFAULT_WATCHDOG_USEC = 432000 * 1000 * 1000
+# Number of seconds between watchdog heartbeats while idle between passes.
+_IDLE_PING_INTERVAL = 30
 
 
 def entrypoint() -> None:
@@ -25,27 +34,37 @@ def entrypoint() -> None:
     config_ = config.ScannerConfig(args.config_file)
 
     # Setup logging.
-    logging.addLevelName(100, "NOTIFY")
     queue_log_handler = util.QueueLogger(
         __name__,
         log_config=config_.scanner["daemon"]["logging_config"],
     )
 
     # Create or update the index in elasticsearch.
-    elastic.init(config_.scanner["elastic"])
+    elastic.init(config_.scanner["elastic"], elastic.pool_size(config_.scanner))
     elastic_q = util.ElasticQueueWorker(config_.scanner)
 
+    # One long-lived client, so connections to the projects portal are reused.
+    portal_client = authlib.integrations.httpx_client.OAuth2Client(
+        config_.scanner["daemon"]["client_id"],
+        config_.scanner["daemon"]["client_secret"],
+        scope=" ".join(config_.scanner["daemon"]["scopes"]),
+        transport=httpx.HTTPTransport(retries=30),
+    )
+    gws_list = GWSListRefresher(portal_client, config_.scanner["daemon"], queue_log_handler.queue)
+
     # Startup tasks complete.
     system_notify.notify(f"MAINPID={os.getpid()}")
     system_notify.notify("READY=1")
     try:
-        main(system_notify, args, config_, elastic_q, queue_log_handler)
+        main(system_notify, args, config_, elastic_q, queue_log_handler, gws_list)
     finally:
         # Make sure that the queues always get cleanly shutdown on any exception.
         # This is the reason for having a seperate setup() function.
         system_notify.notify("STOPPING=1")
+        gws_list.shutdown()
         elastic_q.shutdown()
         queue_log_handler.shutdown()
+        portal_client.close()
 
 
 def main(
@@ -54,6 +73,7 @@ def main(
     config_: config.ScannerConfig,
     elastic_q: util.ElasticQueueWorker,
     queue_log_handler: util.QueueLogger,
+    gws_list: "GWSListRefresher",
 ) -> None:
     """Scan GWSs forever in a loop."""
     logger = util.getLogger(__name__, queue=queue_log_handler.queue)
@@ -61,11 +81,17 @@ def main(
     fail_count = 0
     total_successful_scans = 0
     last_notify_nonexistent = dt.datetime(1, 1, 1)
+    # The timeout set in the unit, which the daemon may lower or raise for a while.
+    unit_watchdog_usec = int(os.environ.get("WATCHDOG_USEC", _DEFAULT_WATCHDOG_USEC))
 
     while True:
         scan_started_at = dt.datetime.now()
+        # Undo the timeout of the last scan or idle period, fetching the list and scan
+        # info can be slow.
+        heartbeat_interval = _set_watchdog(system_notify, unit_watchdog_usec)
+        last_heartbeat = time.monotonic()
         try:
-            toscan = get_gws_list(config_.scanner["daemon"])
+            toscan = gws_list.get()
         except httpx.RequestError:
             logger.error("Failed to load paths to scan. Quitting")
             break
@@ -75,17 +101,49 @@ def main(
 
         logger.info("###### Loaded %s paths to scan. ######", len(toscan))
         non_existent_gws = set()
+        pass_scanned = 0
+        pass_skipped = 0
+
+        # Scan from the end of the list, but leave the list itself alone.
+        scan_order = [gws.strip().rstrip("/") for gws in reversed(toscan)]
+        # Look up when everything was last scanned in one go.
+        system_notify.notify("WATCHDOG=1")
+        scan_info_map = queries.latest_scan_info_bulk(
+            scan_order, config_.scanner["elastic"]["volume_index_name"]
+        )
+        system_notify.notify("WATCHDOG=1")
+        last_heartbeat = time.monotonic()
+        # Work out when each GWS may next be scanned up front, so it's parsed only once.
+        max_interval = dt.timedelta(days=config_.scanner["daemon"]["max_scan_interval_days"])
+        next_scan_allowed = {
+            path: dt.datetime.fromisoformat(info["end_timestamp"]) + max_interval
+            for path, info in scan_info_map.items()
+            if info["status"] == "complete"
+        }
+        for idx, gws in enumerate(scan_order):
+            # Tell systemd we are still alive, but not on every loop as most GWSs are skipped.
+            if time.monotonic() - last_heartbeat > heartbeat_interval:
+                system_notify.notify("WATCHDOG=1")
+                last_heartbeat = time.monotonic()
+
+            # Check the GWS exists first, it's the cheapest way to rule it out.
+            try:
+                stat_ = os.stat(gws)
+            except FileNotFoundError:
+                non_existent_gws.add(gws)
+                continue
+            except PermissionError:
+                logger.warning("PermissionError when accessing %s", gws)
+                continue
+            if not stat.S_ISDIR(stat_.st_mode):
+                logger.warning("%s is not a directory, skipping scan.", gws)
+                continue
 
-        while toscan:
-            # Tell systemd we are still alive every loop.
-            system_notify.notify("WATCHDOG=1")
-
-            gws = toscan.pop().strip().rstrip("/")
-
-            last_scan_info = queries.latest_scan_info(
-                gws, config_.scanner["elastic"]["volume_index_name"]
-            )
-            if not should_scan(gws, config_.scanner, logger, last_scan_info):
+            # Scans can take days, so this can't be hoisted out of the loop.
+            now = dt.datetime.now()
+            last_scan_info = scan_info_map.get(gws)
+            if not should_scan(gws, now, next_scan_allowed.get(gws), logger):
+                pass_skipped += 1
                 continue
 
             # Give the systemd watchdog an idea of how long this will take so that if it's
@@ -96,53 +154,54 @@ def main(
                 predicted_time = 259200
             # watchdog_usec is in microseconds.
             time_allowed = int(predicted_time * 4) * 1000 * 1000
-            system_notify.notify("WATCHDOG=1")
-            system_notify.notify(f"WATCHDOG_USEC={time_allowed}")
-            system_notify.notify("WATCHDOG=1")
-
+            heartbeat_interval = _set_watchdog(system_notify, time_allowed)
+            last_heartbeat = time.monotonic()
+
+            logger.info("Started scan of %s.", gws)
+            # The previous scan may have added new users or filetypes to the mapping.
+            queries.clear_mapping_cache()
+            # Users may have been added or renamed since the last scan.
+            categorize.username_from_uid.cache_clear()
             try:
-                os.scandir(gws)
-            except FileNotFoundError:
-                non_existent_gws.add(gws)
-            except PermissionError:
-                logger.warning("PermissionError when accessing %s", gws)
+                scan_single.scan_single_gws(gws, config_, elastic_q.queue, queue_log_handler.queue)
+            except errors.AbortError as err:
+                logger.error(
+                    "Scan of %s aborted due to an error in another process. Skipping.", gws
+                )
+                if fail_count >= config_.scanner["daemon"]["fail_threshold"]:
+                    logger.critical("Failure threshold reached. The process will exit.")
+                    system_notify.notify("WATCHDOG=trigger")
+                    raise errors.AbortScanError from err
+                fail_count += 1
+                logger.error(
+                    "There have been %s failures, so far, will exit at %s",
+                    fail_count,
+                    config_.scanner["daemon"]["fail_threshold"],
+                )
             else:
-                logger.info("Started scan of %s.", gws)
-                try:
-                    scan_single.scan_single_gws(
-                        gws, config_, elastic_q.queue, queue_log_handler.queue
-                    )
-                except errors.AbortError as err:
-                    logger.error(
-                        "Scan of %s aborted due to an error in another process. Skipping.", gws
-                    )
-                    if fail_count >= config_.scanner["daemon"]["fail_threshold"]:
-                        logger.critical("Failure threshold reached. The process will exit.")
-                        system_notify.notify("WATCHDOG=trigger")
-                        raise errors.AbortScanError from err
-                    fail_count += 1
-                    logger.error(
-                        "There have been %s failures, so far, will exit at %s",
-                        fail_count,
-                        config_.scanner["daemon"]["fail_threshold"],
-                    )
-                else:
-                    total_successful_scans += 1
-                    logger.info(
-                        "Successfully scanned %s. %s left. %s scans completed in total.",
-                        gws,
-                        len(toscan),
-                        total_successful_scans,
-                    )
-                    fail_count = 0
+                total_successful_scans += 1
+                pass_scanned += 1
+                logger.info(
+                    "Successfully scanned %s. %s left. %s scans completed in total.",
+                    gws,
+                    len(scan_order) - idx - 1,
+                    total_successful_scans,
+                )
+                fail_count = 0
+
+        logger.info(
+            "###### Scanned %s paths and skipped %s recently scanned paths in %s. ######",
+            pass_scanned,
+            pass_skipped,
+            dt.datetime.now() - scan_started_at,
+        )
 
         # Don't spam the slack channel with notifications, just send them once a day.
-        if non_existent_gws and (
-            last_notify_nonexistent + dt.timedelta(days=1) < dt.datetime.now()
-        ):
+        now = dt.datetime.now()
+        if non_existent_gws and (last_notify_nonexistent + dt.timedelta(days=1) < now):
             for gws in non_existent_gws:
                 logger.log(100, "%s does not exist.", gws)
-            last_notify_nonexistent = dt.datetime.now()
+            last_notify_nonexistent = now
 
         if not args.run_forever:
             break
@@ -150,64 +209,157 @@ def main(
         # If all the GWSs have been scanned recently, sleep for a while.
         if scan_started_at + dt.timedelta(minutes=5) > dt.datetime.now():
             logger.info("Scan of all GWSs finished very rapidly, sleeping for a while.")
+            _set_watchdog(system_notify, _IDLE_PING_INTERVAL * 3 * 1000 * 1000)
+            if _idle(system_notify, 3600):
+                logger.info("Received SIGTERM while sleeping. Quitting")
+                break
+
+
+def _idle(system_notify: sdnotify.SystemdNotifier, seconds: float) -> bool:
+    """Wait, keeping the systemd watchdog happy, and return True if SIGTERM was received.
+
+    The handler is only installed while waiting, scan processes are forked at other times
+    and should not inherit it.
+    """
+    stop = th.Event()
+    previous = signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    try:
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            if stop.wait(timeout=min(_IDLE_PING_INTERVAL, deadline - time.monotonic())):
+                return True
             system_notify.notify("WATCHDOG=1")
-            system_notify.notify("WATCHDOG_USEC=4200")
-            system_notify.notify("WATCHDOG=1")
-            time.sleep(3600)
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+    return False
+
+
+def _set_watchdog(system_notify: sdnotify.SystemdNotifier, usec: int) -> float:
+    """Ping the watchdog and change its timeout, returning the seconds between heartbeats.
+
+    Heartbeats are sent three times per timeout, so a single slow call doesn't trip it.
+    """
+    _notify_many(system_notify, ["WATCHDOG=1", f"WATCHDOG_USEC={usec}"])
+    return usec / 3 / 1000 / 1000
+
 
+def _notify_many(system_notify: sdnotify.SystemdNotifier, messages: list[str]) -> None:
+    """Send several assignments to systemd in a single notification."""
+    system_notify.notify("\n".join(messages))
 
-def get_gws_list(daemon_config: config.DaemonSchema) -> list[str]:
+
+def get_gws_list(
+    client: authlib.integrations.httpx_client.OAuth2Client,
+    daemon_config: config.DaemonSchema,
+) -> list[str]:
     """Get a list of paths to scan from the projects portal."""
-    client = authlib.integrations.httpx_client.OAuth2Client(
-        daemon_config["client_id"],
-        daemon_config["client_secret"],
-        scope=" ".join(daemon_config["scopes"]),
-        transport=httpx.HTTPTransport(retries=30),
+    # Only get a new token if we don't have one or it is about to expire.
+    if not client.token or client.token.is_expired(leeway=60):
+        client.fetch_token(daemon_config["token_endpoint"], grant_type="client_credentials")
+    # orjson parses the raw bytes, without decoding to a str first.
+    projects_services = orjson.loads(
+        client.get(
+            daemon_config["services_endpoint"],
+            headers={"Accept": "application/json"},
+            timeout=60,
+        ).content
     )
-    client.fetch_token(daemon_config["token_endpoint"], grant_type="client_credentials")
-    projects_services = client.get(
-        daemon_config["services_endpoint"],
-        headers={"Accept": "application/json"},
-        timeout=60,
-    ).json()
-
-    services: list[str] = daemon_config["extra_to_scan"]
-    for service in reversed(projects_services):
+
+    services: list[str] = list(daemon_config["extra_to_scan"])
+    # Sets make checking for duplicates and excluded paths cheap.
+    seen = set(services)
+    never_scan = frozenset(daemon_config["never_scan"])
+    candidates = (
+        # This will remove any double or trailing slashes.
+        os.path.normpath(req["location"])
+        for service in reversed(projects_services)
         # Only look for group workspaces.
-        if service["category"] == 1:
-            for req in service["requirements"]:
-                # Only provisioned requrests should be scanned, they have a status of 50.
-                # If it doesn't start with a / it's probably not a path.
-                if req["status"] == 50 and req["location"].startswith("/"):
-                    # This will remove any double or trailing slashes.
-                    sanitized = str(pathlib.PurePath(req["location"]))
-                    # Remove duplicates any anything in the never_scan list.
-                    if (sanitized not in services) and (
-                        sanitized not in daemon_config["never_scan"]
-                    ):
-                        services.append(sanitized)
+        if service["category"] == 1
+        for req in service["requirements"]
+        # Only provisioned requrests should be scanned, they have a status of 50.
+        # If it doesn't start with a / it's probably not a path.
+        if req["status"] == 50 and req["location"].startswith("/")
+    )
+    for sanitized in candidates:
+        # Remove duplicates any anything in the never_scan list.
+        if (sanitized not in seen) and (sanitized not in never_scan):
+            seen.add(sanitized)
+            services.append(sanitized)
     return services
 
 
+class GWSListRefresher:
+    """Keep the list of paths to scan up to date in a background thread.
+
+    This means the scan loop doesn't have to wait for the projects portal.
+    """
+
+    def __init__(
+        self,
+        client: authlib.integrations.httpx_client.OAuth2Client,
+        daemon_config: config.DaemonSchema,
+        log_q: queue_.Queue[typing.Any],
+    ):
+        self._client = client
+        self._daemon_config = daemon_config
+        self._interval = daemon_config.get("gws_list_ttl_seconds", 300)
+        self._logger = util.getLogger(f"{__name__}.refresher", queue=log_q)
+
+        self._gws_list: typing.Optional[list[str]] = None
+        self._lock = th.Lock()
+        # The client is not shared between the thread and a fetch from get().
+        self._fetch_lock = th.Lock()
+
+        # Used to signal to the thread it should exit.
+        self._shutdown = th.Event()
+        self._thread = th.Thread(target=self._refresh, daemon=True)
+        self._thread.start()
+
+    def _fetch(self) -> list[str]:
+        with self._fetch_lock:
+            gws_list = get_gws_list(self._client, self._daemon_config)
+        with self._lock:
+            self._gws_list = gws_list
+        return gws_list
+
+    def _refresh(self) -> None:
+        while not self._shutdown.wait(self._interval):
+            try:
+                self._fetch()
+            except Exception:  # pylint: disable=broad-except
+                self._logger.exception("Failed to refresh paths to scan, keeping the old list.")
+
+    def get(self) -> list[str]:
+        """Return the latest list of paths to scan, fetching it if there isn't one yet."""
+        with self._lock:
+            gws_list = self._gws_list
+        if gws_list is None:
+            gws_list = self._fetch()
+        # The caller is free to shuffle and pop from the list it gets.
+        return list(gws_list)
+
+    def shutdown(self) -> None:
+        """Stop refreshing the list.
+
+        A fetch which is in progress is not waited for, the thread is a daemon thread.
+        """
+        self._shutdown.set()
+
+
 def should_scan(
     path: str,
-    config_: config.ScannerSchema,
+    now: dt.datetime,
+    next_scan_allowed: typing.Optional[dt.datetime],
     logger: logging.Logger,
-    last_scan_info: typing.Optional[dict[str, typing.Any]],
 ) -> bool:
-    """Check if a GWS should be scanned."""
-    if last_scan_info is None:
-        return True
-
-    if last_scan_info["status"] == "complete":
-        next_scan_allowed = dt.datetime.fromisoformat(
-            last_scan_info["end_timestamp"]
-        ) + dt.timedelta(days=config_["daemon"]["max_scan_interval_days"])
-        if next_scan_allowed > dt.datetime.now():
-            logger.warning(
-                "%s has been scanned within max_scan_interval_days, skipping scan.", path
-            )
-            return False
+    """Check if a GWS should be scanned, as of now.
+
+    next_scan_allowed is None if the GWS has never had a complete scan.
+    """
+    if next_scan_allowed is not None and next_scan_allowed > now:
+        # Most GWSs are skipped on most passes, so this is summarised at the end of each pass.
+        logger.debug("%s has been scanned within max_scan_interval_days, skipping scan.", path)
+        return False
 
     return True
 
@@ -1,19 +1,26 @@
 """Module which sends data to elasticsearch."""
 import datetime as dt
+import logging
 import multiprocessing as mp
 import queue as queue_
 import threading as th
+import time
 import typing
 
+import elasticsearch.exceptions
 import elasticsearch.helpers as esh
 import elasticsearch_dsl as esd
+import elasticsearch_dsl.serializer
+import orjson
 
 from . import config, models, util
 
+logger = logging.getLogger()
 
-def init(elastic_config: config.ElasticSchema) -> None:
-    """Initialise elasticsearch."""
-    conn = get_connection(elastic_config)
+
+def init(elastic_config: config.ElasticSchema, maxsize: int = 10) -> None:
+    """Initialise elasticsearch, and this process's connection with a pool of maxsize."""
+    conn = get_connection(elastic_config, maxsize)
 
     ensure_index(
         elastic_config["data_index_name"],
@@ -82,11 +89,65 @@ def migrate(
         )
 
 
-def get_connection(config_: config.ElasticSchema) -> typing.Any:
-    """Create a connection to elasticsearch."""
+# Retries of documents rejected because elasticsearch is busy, the same as streaming_bulk's
+# defaults. The backoff is in seconds and doubles with each retry.
+_BUSY_MAX_RETRIES = 3
+_BUSY_INITIAL_BACKOFF = 2
+_BUSY_MAX_BACKOFF = 600
+
+# Timezone aware UTC datetimes are written with a "Z" suffix, which is shorter.
+_ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_UTC_Z
+
+
+class OrjsonSerializer(elasticsearch_dsl.serializer.AttrJSONSerializer):
+    """Serialize requests and responses with orjson, which is much faster than json.
+
+    Aggregation responses with a bucket for every user and filetype are large,
+    and bulk requests have one document per scanned folder. Objects orjson doesn't know,
+    such as elasticsearch-dsl's AttrList and AttrDict, are converted by default().
+    """
+
+    def loads(self, s: typing.Any) -> typing.Any:
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError as err:
+            raise elasticsearch.exceptions.SerializationError(s, err)
+
+    def dumps(self, data: typing.Any) -> typing.Any:
+        # Don't serialize strings.
+        if isinstance(data, str):
+            return data
+
+        try:
+            return orjson.dumps(data, default=self.default, option=_ORJSON_OPTIONS).decode()
+        except orjson.JSONEncodeError as err:
+            raise elasticsearch.exceptions.SerializationError(data, err)
+
+
+_SERIALIZER = OrjsonSerializer()
+
+
+def dumps_source(doc: dict[str, typing.Any]) -> str:
+    """Serialize the source of a document for indexing.
+
+    The bulk helpers send strings as they are, so documents can be serialized where they
+    are made, and only a string is pickled to pass them between processes.
+    """
+    source: str = _SERIALIZER.dumps(doc["_source"])
+    return source
+
+
+def get_connection(config_: config.ElasticSchema, maxsize: int = 10) -> typing.Any:
+    """Create a connection to elasticsearch.
+
+    The connection keeps a pool of up to maxsize keep-alive HTTP connections per node, so it
+    should be created once per process and reused, rather than created for each request.
+    """
     esd.connections.create_connection(
         alias="default",
         hosts=config_["hosts"],
+        http_compress=True,
+        maxsize=maxsize,
         use_ssl=config_["use_ssl"],
         ca_certs=config_["ca_certs"],
         timeout=config_["timeout"],
@@ -97,37 +158,102 @@ def get_connection(config_: config.ElasticSchema) -> typing.Any:
         sniffer_timeout=60,
         sniff_on_connection_fail=True,
         snif_timeout=10,
+        serializer=OrjsonSerializer(),
     )
     return esd.connections.get_connection()
 
 
+def pool_size(config_: config.ScannerSchema) -> int:
+    """Number of connections a process needs, enough for every thread which could use one."""
+    return max(
+        config_["elastic"].get("bulk_thread_count", 4),
+        config_["scan_max_threads_per_process"],
+    )
+
+
+def bulk_options(elastic_config: config.ElasticSchema) -> dict[str, typing.Any]:
+    """Keyword arguments for esh.parallel_bulk from the config."""
+    return {
+        "thread_count": elastic_config.get("bulk_thread_count", 4),
+        "queue_size": elastic_config.get("bulk_queue_size", 8),
+        "chunk_size": elastic_config.get("bulk_chunk_size", 1000),
+        # Stay well under elasticsearch's default http.max_content_length of 100MB.
+        "max_chunk_bytes": elastic_config.get("bulk_max_chunk_bytes", 50 * 1024 * 1024),
+    }
+
+
 def worker(
-    inqueue: queue_.Queue[models.File],
+    inqueue: "util.CancellableJoinableQueue",
     config_: config.ScannerSchema,
     shutdown: th.Event,
 ) -> None:
-    """Consumes Folder objects and send them to elasticsearch."""
+    """Consumes batches of Folder objects and send them to elasticsearch."""
     proc = mp.current_process()
     proc.name = f"elastic-{proc.name}"
 
     elastic_config = config_["elastic"]
 
-    get_connection(elastic_config)
+    get_connection(elastic_config, pool_size(config_))
     connection = esd.connections.get_connection()
 
-    staging: list[models.File] = []
+    batch_size = max(1000, config_["queue_length_scale_factor"])
+    staging: list[str] = []
+    # Number of sends in a row which elasticsearch has rejected documents from as busy.
+    busy_retries = 0
     while (not shutdown.is_set()) or (len(staging) > 0):
         send = False
         try:
-            staging.append(inqueue.get(timeout=10))
-            inqueue.task_done()
+            staging.extend(inqueue.get(timeout=10))
         except queue_.Empty:
             send = True
+        else:
+            taken = 1
+            # Take whatever else is already waiting without blocking.
+            while len(staging) < batch_size:
+                try:
+                    staging.extend(inqueue.get_nowait())
+                except queue_.Empty:
+                    break
+                taken += 1
+            # Mark everything taken as done at once.
+            inqueue.task_done(taken)
         if len(staging) > 0:
-            if (len(staging) >= max(1000, config_["queue_length_scale_factor"])) or send:
-                esh.bulk(
+            if (len(staging) >= batch_size) or send:
+                failed = 0
+                retry = []
+                # Results come back in the same order as the documents were sent.
+                results = esh.parallel_bulk(
                     connection,
                     staging,
                     index=elastic_config["data_index_name"],
+                    raise_on_error=False,
+                    raise_on_exception=False,
+                    **bulk_options(elastic_config),
                 )
+                for doc, (ok, result) in zip(staging, results):
+                    if ok:
+                        continue
+                    # Documents rejected because elasticsearch is busy go in the next batch.
+                    if next(iter(result.values())).get("status") == 429:
+                        retry.append(doc)
+                    else:
+                        failed += 1
+                if failed:
+                    logger.error("Failed to index %s of %s documents.", failed, len(staging))
                 staging.clear()
+                if not retry:
+                    busy_retries = 0
+                elif busy_retries >= _BUSY_MAX_RETRIES:
+                    logger.error(
+                        "Failed to index %s documents, elasticsearch is still busy after %s "
+                        "retries.",
+                        len(retry),
+                        busy_retries,
+                    )
+                    busy_retries = 0
+                else:
+                    # Back off exponentially, as streaming_bulk does, so a busy cluster
+                    # isn't sent the same documents again straight away.
+                    time.sleep(min(_BUSY_MAX_BACKOFF, _BUSY_INITIAL_BACKOFF * 2**busy_retries))
+                    busy_retries += 1
+                    staging.extend(retry)
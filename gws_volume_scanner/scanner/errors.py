@@ -4,6 +4,8 @@
 class ScannerConfigError(TypeError):
     """Base class for all configuration errors."""
 
+    __slots__ = ()
+
 
 class ScannerMainConfigError(ScannerConfigError):
     """Raised if the main scanner configuration is unparseable.
@@ -11,6 +13,8 @@ class ScannerMainConfigError(ScannerConfigError):
     This is likely to result in the scanner failing to start.
     """
 
+    __slots__ = ()
+
 
 class ScannerGWSConfigError(ScannerConfigError):
     """Raised in configuration for a specific GWS is unparseable.
@@ -18,6 +22,8 @@ class ScannerGWSConfigError(ScannerConfigError):
     This is likely to result in the scanner falling back on defaults.
     """
 
+    __slots__ = ()
+
 
 class FileNotFoundWarning(Warning):
     """Warning which catches a FileNotFoundError and warns about it instead.
@@ -25,10 +31,16 @@ class FileNotFoundWarning(Warning):
     This can happen if a file was moved under the scanner.
     """
 
+    __slots__ = ()
+
 
 class AbortError(OSError):
     """Raised when a scanner thread fails."""
 
+    __slots__ = ()
+
 
 class AbortScanError(AbortError):
     """Raised when there are too many failures and the scanner should exit."""
+
+    __slots__ = ()
@@ -1,15 +1,15 @@
 """Elasticsearch Model for the GWS Scanner."""
 import collections
 import datetime as dt
-import multiprocessing as mp
 import os
+import time
 import typing
 import warnings
 
 import elasticsearch_dsl as esd
 
 from ..client import queries
-from . import categorize, errors
+from . import categorize, errors, statx
 
 
 def dict_count_size() -> typing.Dict[str, int]:
@@ -26,6 +26,57 @@ def dict_count_size_heat() -> typing.Dict[str, typing.Any]:
     }
 
 
+def es_path(path: str) -> str:
+    """Strip the trailing slash from a path, and make sure it is safe for elasticsearch.
+
+    Nasty workaround to make sure no bad characters get to elasticsearch.
+    This will limit the character set to Latin1, and probably print weird
+    things if other character sets are in the input.
+    """
+    path = str(path).rstrip("/")
+    # ASCII is the same in both encodings, so almost all paths can skip the round trip.
+    if path.isascii():
+        return path
+    return path.encode("utf-8", "surrogateescape").decode("ISO-8859-1")
+
+
+def build_file_doc(
+    path: str, stat_: os.stat_result, start_timestamp: dt.datetime, scan_id: str
+) -> typing.Dict[str, typing.Any]:
+    """Build the document for a single file, the same as File(...).to_dict(True) would.
+
+    Building a plain dict is much cheaper than a File, so it's used for files which
+    will not have children incorporated into them.
+    """
+    # The size on disk is the number of blocks multipled by 512, see File.
+    size_ondisk = stat_.st_blocks * 512
+    count_size = {"count": 1, "size": size_ondisk}
+
+    username = categorize.username_from_uid(stat_.st_uid)
+    atime = dt.datetime.fromtimestamp(stat_.st_atime)
+    ftype = categorize.detect_filetype(path, stat_)
+    heat = categorize.get_time_bin_from_timestamp(stat_.st_atime, time.time())
+
+    return {
+        "_source": {
+            "path": es_path(path),
+            "size": size_ondisk,
+            "owner": username,
+            "count": 1,
+            "atime": atime,
+            "filetype": ftype,
+            "includes_children": False,
+            "filetypes": {ftype: count_size},
+            "size_bins": {categorize.get_size_bin(size_ondisk): count_size.copy()},
+            "heat_bins": {heat: count_size.copy()},
+            "users": {username: count_size.copy()},
+            "start_timestamp": start_timestamp,
+            "scan_id": scan_id,
+            "mean_heat": start_timestamp.timestamp() - stat_.st_atime,
+        }
+    }
+
+
 ES_PATHTYPE = esd.Keyword(
     fields={
         "tree": esd.Text(
@@ -48,11 +99,22 @@ ES_PATHTYPE = esd.Keyword(
 )
 
 
+# The attributes of File holding the flat counts and sizes of each bin.
+_BIN_ATTRS = (
+    "_filetypes_count",
+    "_filetypes_size",
+    "_size_bins_count",
+    "_size_bins_size",
+    "_heat_bins_count",
+    "_heat_bins_size",
+    "_users_count",
+    "_users_size",
+)
+
+
 class File(esd.Document):
     """This class defines the shape of how GWS data is stored in in elasticsearch."""
 
-    __lock = mp.RLock()
-
     class Meta:
         dynamic = esd.MetaField("strict")
 
@@ -78,6 +140,22 @@ class File(esd.Document):
     heat_bins = esd.Object(dynamic=True)
     users = esd.Object(dynamic=True)
 
+    # The start of the scan as seconds since the epoch, for working out ages of children.
+    # This is defined on the class so that setting it doesn't add it to the document.
+    _start_epoch = 0.0
+
+    # Flat counts and sizes behind filetypes, size_bins, heat_bins and users.
+    # Like _start_epoch, these are defined on the class to keep them out of the document,
+    # each instance gets its own dicts in __init__, even if the file can't be stat'd.
+    _filetypes_count: typing.Dict[str, int] = {}
+    _filetypes_size: typing.Dict[str, int] = {}
+    _size_bins_count: typing.Dict[str, int] = {}
+    _size_bins_size: typing.Dict[str, int] = {}
+    _heat_bins_count: typing.Dict[str, int] = {}
+    _heat_bins_size: typing.Dict[str, int] = {}
+    _users_count: typing.Dict[str, int] = {}
+    _users_size: typing.Dict[str, int] = {}
+
     def __init__(
         self,
         path: str,
@@ -92,116 +170,170 @@ class File(esd.Document):
         """
         try:
             if stat_ is None:
-                stat_ = os.lstat(path)
+                stat_ = statx.fast_lstat(path)
         except (FileNotFoundError, PermissionError) as err:
             warnings.warn(errors.FileNotFoundWarning(err))
+            # A document with nothing counted yet, so the object is still safe to use.
+            super().__init__(
+                path=es_path(path),
+                size=0,
+                count=0,
+                mean_heat=0,
+                start_timestamp=start_timestamp,
+                scan_id=scan_id,
+            )
+            self._start_epoch = start_timestamp.timestamp()
+            for name in _BIN_ATTRS:
+                setattr(self, name, {})
         else:
-            with self.__lock:
-                kwargs: typing.Dict[str, typing.Any] = {}
-                # Because of how the base class works, we cannot set these ourselves.
-                # Cobnstruct arguments to pass to the constructor instead.
-
-                # Nasty workaround to make sure no bad characters get to elasticsearch.
-                # This will limit the character set to Latin1, and probably print weird
-                # things if other character sets are in the input.
-                kwargs["path"] = (
-                    (str(path).rstrip("/")).encode("utf-8", "surrogateescape").decode("ISO-8859-1")
-                )
-
-                # The size on disk is the number of blocks multipled by 512 (https://docs.python.org/3/library/os.html#os.stat_result.st_blocks).
-                # Note that the result of st_blocks is unrelated to st_blksize.
-                size_ondisk = stat_.st_blocks * 512
-                # apparent_size = stat_.st_size
-
-                kwargs["size"] = size_ondisk
-                username = categorize.username_from_uid(stat_.st_uid)
-                kwargs["owner"] = username
-                kwargs["count"] = 1
-
-                atime = dt.datetime.fromtimestamp(stat_.st_atime)
-                kwargs["atime"] = atime
-
-                ftype = categorize.detect_filetype(path, stat_)
-                kwargs["filetype"] = ftype
-
-                kwargs["includes_children"] = False
-
-                # We don't know what chidren of these objects will exist yet.
-                # While all this information is also collected above, if
-                # we don't do it here we won't know about aggregated children.
-                kwargs["filetypes"] = collections.defaultdict(dict_count_size)
-                kwargs["size_bins"] = collections.defaultdict(dict_count_size)
-                kwargs["heat_bins"] = collections.defaultdict(dict_count_size)
-                kwargs["users"] = collections.defaultdict(dict_count_size)
-
-                # Add the values for this object. Children might be agregated later.
-                # Types.
-                kwargs["filetypes"][ftype]["count"] += 1
-                kwargs["filetypes"][ftype]["size"] += size_ondisk
-
-                # Size bins.
-                bin_ = categorize.get_size_bin(size_ondisk)
-                kwargs["size_bins"][bin_]["count"] += 1
-                kwargs["size_bins"][bin_]["size"] += size_ondisk
-
-                # Heat.
-                heat = categorize.get_time_bin(atime)
-                kwargs["heat_bins"][heat]["count"] += 1
-                kwargs["heat_bins"][heat]["size"] += size_ondisk
-
-                # Users.
-                kwargs["users"][username]["count"] += 1
-                kwargs["users"][username]["size"] += size_ondisk
-
-                # Add a timestamp to the object in elasticsearch.
-                kwargs["start_timestamp"] = start_timestamp
-                kwargs["scan_id"] = scan_id
-
-                # Calculate the age of the object. This will become a mean if children
-                # Are incorprated.
-                kwargs["mean_heat"] = (start_timestamp - atime).total_seconds()
-
-                super().__init__(**kwargs)
+            kwargs: typing.Dict[str, typing.Any] = {}
+            # Because of how the base class works, we cannot set these ourselves.
+            # Cobnstruct arguments to pass to the constructor instead.
+
+            kwargs["path"] = es_path(path)
+
+            # The size on disk is the number of blocks multipled by 512 (https://docs.python.org/3/library/os.html#os.stat_result.st_blocks).
+            # Note that the result of st_blocks is unrelated to st_blksize.
+            size_ondisk = stat_.st_blocks * 512
+            # apparent_size = stat_.st_size
+
+            kwargs["size"] = size_ondisk
+            username = categorize.username_from_uid(stat_.st_uid)
+            kwargs["owner"] = username
+            kwargs["count"] = 1
+
+            atime = dt.datetime.fromtimestamp(stat_.st_atime)
+            kwargs["atime"] = atime
+
+            ftype = categorize.detect_filetype(path, stat_)
+            kwargs["filetype"] = ftype
+
+            kwargs["includes_children"] = False
+
+            # Type, size, heat and user bins are kept as flat counts and sizes while
+            # children are agregated, and only nested for elasticsearch by to_dict().
+            bin_ = categorize.get_size_bin(size_ondisk)
+            heat = categorize.get_time_bin_from_timestamp(stat_.st_atime, time.time())
+
+            # Add a timestamp to the object in elasticsearch.
+            kwargs["start_timestamp"] = start_timestamp
+            kwargs["scan_id"] = scan_id
+
+            # Calculate the age of the object. This will become a mean if children
+            # Are incorprated.
+            start_epoch = start_timestamp.timestamp()
+            kwargs["mean_heat"] = start_epoch - stat_.st_atime
+
+            super().__init__(**kwargs)
+            self._start_epoch = start_epoch
+
+            # Add the values for this object. Children might be agregated later.
+            self._filetypes_count = {ftype: 1}
+            self._filetypes_size = {ftype: size_ondisk}
+            self._size_bins_count = {bin_: 1}
+            self._size_bins_size = {bin_: size_ondisk}
+            self._heat_bins_count = {heat: 1}
+            self._heat_bins_size = {heat: size_ondisk}
+            self._users_count = {username: 1}
+            self._users_size = {username: size_ondisk}
 
     def incorporate_child(self, path: str, stat_: typing.Optional[os.stat_result] = None) -> None:
         """Agregate the information about another file into this file."""
         try:
             if stat_ is None:
-                stat_ = os.lstat(path)
+                stat_ = statx.fast_lstat(path)
         except (FileNotFoundError, PermissionError) as err:
             warnings.warn(errors.FileNotFoundWarning(err))
         else:
-            with self.__lock:
-                # The size on disk is the number of blocks multipled by 512 (https://docs.python.org/3/library/os.html#os.stat_result.st_blocks).
-                # Note that the result of st_blocks is unrelated to st_blksize.
-                size_ondisk = stat_.st_blocks * 512
-                # apparent_size = stat_.st_size
-
-                self.size += size_ondisk
-                self.count += 1
-
-                ftype = categorize.detect_filetype(path, stat_)
-                self.filetypes[ftype]["count"] += 1
-                self.filetypes[ftype]["size"] += size_ondisk
+            self.incorporate_children([(path, stat_)])
 
-                bin_ = categorize.get_size_bin(size_ondisk)
-                self.size_bins[bin_]["count"] += 1
-                self.size_bins[bin_]["size"] += size_ondisk
+    def incorporate_children(self, children: typing.Sequence[tuple[str, os.stat_result]]) -> None:
+        """Agregate a chunk of files, with their stats, into this file.
 
-                heat = categorize.get_time_bin(dt.datetime.fromtimestamp(stat_.st_atime))
-                self.heat_bins[heat]["count"] += 1
-                self.heat_bins[heat]["size"] += size_ondisk
+        The chunk is worked through one column at a time, so each bin is a single
+        pass over a list rather than a set of attribute lookups per file.
+        """
+        if not children:
+            return
+        now = time.time()
+        # The size on disk is the number of blocks multipled by 512 (https://docs.python.org/3/library/os.html#os.stat_result.st_blocks).
+        # Note that the result of st_blocks is unrelated to st_blksize.
+        sizes = [stat_.st_blocks * 512 for _, stat_ in children]
+        atimes = [stat_.st_atime for _, stat_ in children]
+
+        for keys, counts, bin_sizes in (
+            (
+                [categorize.detect_filetype(path, stat_) for path, stat_ in children],
+                self._filetypes_count,
+                self._filetypes_size,
+            ),
+            (categorize.get_size_bins(sizes), self._size_bins_count, self._size_bins_size),
+            (categorize.get_time_bins(atimes, now), self._heat_bins_count, self._heat_bins_size),
+            (
+                [categorize.username_from_uid(stat_.st_uid) for _, stat_ in children],
+                self._users_count,
+                self._users_size,
+            ),
+        ):
+            for key, size_ondisk in zip(keys, sizes):
+                counts[key] = counts.get(key, 0) + 1
+                bin_sizes[key] = bin_sizes.get(key, 0) + size_ondisk
+
+        # Add the ages of the chunk into the mean.
+        total_age = len(children) * self._start_epoch - sum(atimes)
+        count = self.count + len(children)
+        self.mean_heat = ((self.mean_heat * self.count) + total_age) / count
+
+        self.size += sum(sizes)
+        self.count = count
+        self.includes_children = True
+
+    def nested_bins(self) -> typing.Dict[str, typing.Any]:
+        """Return filetypes, size_bins, heat_bins and users as they are stored in elasticsearch."""
+        return {
+            field: {key: {"count": count, "size": sizes[key]} for key, count in counts.items()}
+            for field, counts, sizes in (
+                ("filetypes", self._filetypes_count, self._filetypes_size),
+                ("size_bins", self._size_bins_count, self._size_bins_size),
+                ("heat_bins", self._heat_bins_count, self._heat_bins_size),
+                ("users", self._users_count, self._users_size),
+            )
+        }
+
+    def to_dict(self, include_meta: bool = False, skip_empty: bool = True) -> typing.Any:
+        """Serialize the document, nesting the flat counts and sizes into each bin."""
+        doc = super().to_dict(include_meta=include_meta, skip_empty=skip_empty)
+        source = doc["_source"] if include_meta else doc
+        source.update(self.nested_bins())
+        return doc
+
+
+# Every other field a File sets, which are all primitives.
+_FILE_FIELDS = (
+    "path",
+    "size",
+    "owner",
+    "count",
+    "atime",
+    "filetype",
+    "includes_children",
+    "start_timestamp",
+    "scan_id",
+    "mean_heat",
+)
 
-                username = categorize.username_from_uid(stat_.st_uid)
-                self.users[username]["count"] += 1
-                self.users[username]["size"] += size_ondisk
 
-                # Add this object's age into the mean.
-                atime = dt.datetime.fromtimestamp(stat_.st_atime)
-                age = (self.start_timestamp - atime).total_seconds()
-                self.mean_heat = ((self.mean_heat * (self.count - 1)) + age) / self.count
+def fast_to_dict(file: File) -> typing.Dict[str, typing.Any]:
+    """Serialize a File for bulk indexing, the same as file.to_dict(True) would.
 
-                self.includes_children = True
+    This reads the fields directly instead of going through each field's serializer,
+    which none of them need.
+    """
+    # pylint: disable=protected-access
+    # Fields a File couldn't set, because it couldn't be stat'd, are left out.
+    source = {key: file._d_[key] for key in _FILE_FIELDS if key in file._d_}
+    source.update(file.nested_bins())
+    return {"_source": source}
 
 
 class Volume(esd.Document):
@@ -1,5 +1,4 @@
 """Scan a single GWS."""
-import multiprocessing as mp
 import multiprocessing.queues
 import queue as queue_
 import typing
@@ -15,13 +14,13 @@ from . import aggregate, cli, config, elastic, errors, models, scanner, util
 def scan_single_gws(
     path: str,
     config_: config.ScannerConfig,
-    elastic_q: queue_.Queue[models.File],
+    elastic_q: util.CancellableJoinableQueue,
     log_q: queue_.Queue[typing.Any],
 ) -> None:
     """Scan a single GWS."""
     logger = util.getLogger(__name__, queue=log_q)
 
-    abort = mp.Event()
+    abort = util.AbortEvent(ctx=util.scan_context())
 
     scanner_q = util.ScanQueueWorker(config_.scanner, elastic_q, abort)
 
@@ -33,7 +32,7 @@ def scan_single_gws(
     # Add paths into the queue for processing.
     scanner.queuescan(
         path,
-        scanner_q.queue,
+        scanner_q,
         config_,
         volumestats.start_timestamp,
         volumestats.meta.id,
@@ -48,20 +47,25 @@ def scan_single_gws(
         raise errors.AbortError
 
     # Query aggregate data and save the aggregations into es.
-    results = []
     try:
-        results += aggregate.aggregate_filetypes(path, config_.scanner["elastic"], volumestats)
-        results += aggregate.aggregate_users(path, config_.scanner["elastic"], volumestats)
-        results += aggregate.aggregate_heat(path, config_.scanner["elastic"], volumestats)
+        results = aggregate.aggregate(path, config_.scanner["elastic"], volumestats)
     except elasticsearch.exceptions.ConnectionTimeout:
         logger.error("Failed to generate aggregate data for %s", path)
     else:
-        connection = elastic.get_connection(config_.scanner["elastic"])
-        esh.bulk(
+        # Reuse the long-lived connection setup by elastic.init().
+        connection = esd.connections.get_connection()
+        failed = 0
+        for ok, _ in esh.parallel_bulk(
             connection,
             results,
             index=config_.scanner["elastic"]["aggregate_index_name"],
-        )
+            raise_on_error=False,
+            **elastic.bulk_options(config_.scanner["elastic"]),
+        ):
+            if not ok:
+                failed += 1
+        if failed:
+            logger.error("Failed to index %s aggregate records for %s", failed, path)
 
     # Cleanup old views of the tree of this filesystem.
     old_scan_ids = queries.scan_ids(path, config_.scanner["elastic"]["volume_index_name"])
@@ -74,23 +78,34 @@ def scan_single_gws(
             old_scan_ids.remove(volumestats.meta.id)
         except ValueError:
             pass
-        for oldscan in old_scan_ids:
-            scanstatus = models.Volume.get(id=oldscan)
-            if scanstatus.status in ["complete", "in_progress"]:
-                search = esd.Search(index=config_.scanner["elastic"]["data_index_name"]).filter(
-                    "term", scan_id=oldscan
-                )
-                # Paper-over error where elasticsearch tries to delete the same documents twice.
-                search.params(conflicts="proceed")
-                try:
-                    search.delete()
-                except elasticsearch.exceptions.ConflictError:
-                    logger.error("Failed to delete old data for scan id %s", oldscan)
-                if scanstatus.status == "complete":
-                    scanstatus.status = "removed"
-                elif scanstatus.status == "in_progress":
-                    scanstatus.status = "failed"
-                scanstatus.save()
+        # Only scans which are complete or in progress still have data to remove.
+        old_scans = models.Volume.mget(old_scan_ids, missing="skip")
+        to_remove = [scan for scan in old_scans if scan.status in ["complete", "in_progress"]]
+        if to_remove:
+            remove_ids = [scan.meta.id for scan in to_remove]
+            # Delete the data from all of them in a single request.
+            search = esd.Search(index=config_.scanner["elastic"]["data_index_name"]).filter(
+                "terms", scan_id=remove_ids
+            )
+            # Paper-over error where elasticsearch tries to delete the same documents twice.
+            search = search.params(conflicts="proceed")
+            try:
+                search.delete()
+            except elasticsearch.exceptions.ConflictError:
+                logger.error("Failed to delete old data for scan ids %s", remove_ids)
+            # Then update all of their statuses in one bulk request.
+            esh.bulk(
+                esd.connections.get_connection(),
+                (
+                    {
+                        "_op_type": "update",
+                        "_index": scan.meta.index,
+                        "_id": scan.meta.id,
+                        "doc": {"status": "removed" if scan.status == "complete" else "failed"},
+                    }
+                    for scan in to_remove
+                ),
+            )
 
     # Do a query on all the data we just collected and save it to long term stats.
     volumestats.add_endofscan(config_.scanner["elastic"]["data_index_name"])
@@ -112,7 +127,7 @@ def main() -> None:
     )
 
     # Create or update the index in elasticsearch.
-    elastic.init(config_.scanner["elastic"])
+    elastic.init(config_.scanner["elastic"], elastic.pool_size(config_.scanner))
 
     # Create queue/worker for sending data to elasticsearch.
     elastic_q = util.ElasticQueueWorker(config_.scanner)
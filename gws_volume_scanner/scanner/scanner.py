@@ -1,162 +1,338 @@
 """Module which does the scanning of the filesystem."""
-import copy
+import collections
+import concurrent.futures
 import datetime as dt
+import itertools
 import multiprocessing as mp
+import multiprocessing.pool
 import multiprocessing.synchronize
 import os
 import queue as queue_
 import threading as th
 import typing
+import warnings
 
-from ..vendor import os as vos
-from . import config, errors, models, util
+from . import config, elastic, errors, models, statx, util
 
 ToScan = typing.Tuple[str, typing.Sequence[str], typing.Sequence[str], bool, bool, dt.datetime, str]
+# A chunk of paths for a thread to aggregate into a folder.
+ThreadTask = typing.Tuple[models.File, list[str]]
+# The names of the subdirectories and other files in a directory.
+DirListing = typing.Tuple[list[str], list[str]]
+
+# Number of paths handed to a thread at once when aggregating into a folder.
+_THREAD_CHUNK_SIZE = 256
 
 
 def queuescan(
     path: str,
-    queue: queue_.Queue[ToScan],
+    queue: "util.ScanQueueWorker",
     config_: config.ScannerConfig,
     start_timestamp: dt.datetime,
     scan_id: str,
     abort: multiprocessing.synchronize.Event,
 ) -> None:
-    """Walk the given path and places objects to scan in a queue."""
+    """Walk the given path and places objects to scan in the scan workers' queues.
+
+    Directories are listed by a pool of threads, as listing is bound by the filesystem.
+    Each directory is queued as soon as it has been listed, so the order is not the
+    same as os.walk.
+    """
     gwsconfig = config_.gws_config(str(path))
+    # These are checked for every directory, so make the checks constant time.
+    full_item_walk_dirs = frozenset(gwsconfig["full_item_walk_dirs"])
+    aggregate_subdir_paths = frozenset(gwsconfig["aggregate_subdir_paths"])
+    aggregate_subdir_names = frozenset(gwsconfig["aggregate_subdir_names"])
+    scan_depth = gwsconfig["scan_depth"]
+    # Depths are counted from the end of the path, ignoring any trailing slash.
+    path_prefix_len = len(str(path).rstrip("/"))
 
-    # Because we vendor the os module, it's type hints do not get picked up by mypy.
-    for dirpath, dirnames, filenames in vos.walk(path):  # type: ignore[no-untyped-call]
-        depth = len(dirpath.removeprefix(str(path)).strip("/").split("/"))
-
-        walk_items = dirpath in gwsconfig["full_item_walk_dirs"]
-        aggregate_subdirs = (
-            (depth >= gwsconfig["scan_depth"])
-            or (dirpath in gwsconfig["aggregate_subdir_paths"])
-            or (dirpath.strip("/").rpartition("/")[2] in gwsconfig["aggregate_subdir_names"])
-        )
-
-        if aggregate_subdirs:
-            pass_dirnames = copy.deepcopy(dirnames)
-            dirnames.clear()
-        else:
-            pass_dirnames = dirnames
-        while not abort.is_set():
-            try:
-                queue.put(
+    walker_threads = config_.scanner.get("scan_walker_threads", 8)
+    # Directories waiting to be listed. Only a few are submitted at a time, so wide
+    # trees don't fill the executor with futures.
+    to_list = collections.deque([str(path)])
+    listing: dict[concurrent.futures.Future[typing.Optional[DirListing]], str] = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=walker_threads) as executor:
+        while (to_list or listing) and not abort.is_set():
+            while to_list and len(listing) < walker_threads * 2:
+                dirpath = to_list.popleft()
+                listing[executor.submit(list_dir, dirpath)] = dirpath
+            done, _ = concurrent.futures.wait(
+                listing, timeout=5, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            # Everything listed since the last wake up goes in the queue in one put.
+            to_scan: list[ToScan] = []
+            for future in done:
+                dirpath = listing.pop(future)
+                result = future.result()
+                # Directories which can't be read are skipped, as os.walk does.
+                if result is None:
+                    continue
+                dirnames, filenames = result
+
+                # The top of the walk has the same depth as its immediate subdirectories.
+                depth = dirpath.count("/", path_prefix_len) or 1
+
+                walk_items = dirpath in full_item_walk_dirs
+                aggregate_subdirs = (
+                    (depth >= scan_depth)
+                    or (dirpath in aggregate_subdir_paths)
+                    or (os.path.basename(dirpath) in aggregate_subdir_names)
+                )
+
+                # Subdirectories which are aggregated are walked by the worker instead.
+                if not aggregate_subdirs:
+                    to_list.extend(os.path.join(dirpath, dir_) for dir_ in dirnames)
+                to_scan.append(
                     (
                         dirpath,
-                        pass_dirnames,
+                        dirnames,
                         filenames,
                         walk_items,
                         aggregate_subdirs,
                         start_timestamp,
                         scan_id,
-                    ),
-                    timeout=5,
+                    )
                 )
-            except queue_.Full:
-                continue
-            break
-        if abort.is_set():
-            break
+            while to_scan and not abort.is_set():
+                try:
+                    queue.put(to_scan, timeout=5)
+                except queue_.Full:
+                    continue
+                break
+        # Don't start listing anything else if the scan has been aborted.
+        for future in listing:
+            future.cancel()
+
+
+def list_dir(dirpath: str) -> typing.Optional[DirListing]:
+    """List the names of the subdirectories and other files in a directory.
+
+    Like os.walk, symlinks to directories are listed with the files, and None is
+    returned if the directory can't be read.
+    """
+    dirnames = []
+    filenames = []
+    try:
+        with os.scandir(dirpath) as scandir_it:
+            for entry in scandir_it:
+                try:
+                    # Don't follow symlinks, broken symlinks can hang.
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    dirnames.append(entry.name)
+                else:
+                    filenames.append(entry.name)
+    except OSError:
+        return None
+    return dirnames, filenames
 
 
 def worker(
-    inqueue: queue_.Queue[ToScan],
-    outqueue: queue_.Queue[models.File],
+    inqueue: queue_.Queue[typing.Optional[list[ToScan]]],
+    outqueue: queue_.Queue[list[str]],
     config_: config.ScannerSchema,
-    shutdown: th.Event,
     abort: th.Event,
 ) -> None:
-    """Consume results of an OS Walk and runs processing on the paths provided."""
+    """Consume results of an OS Walk and runs processing on the paths provided.
+
+    Runs until it gets None from the queue, or the scan is aborted.
+    """
     proc = mp.current_process()
     proc.name = f"scan-{proc.name}"
 
-    innershutdown = mp.Event()
+    # Each process aggregates into one folder at a time, so one lock is enough.
+    folder_lock = th.Lock()
 
-    thread_q: queue_.Queue[tuple[models.File, str]] = util.CancellableQueue(
+    thread_q: queue_.Queue[typing.Optional[ThreadTask]] = util.CancellableQueue(
         maxsize=config_["scan_max_threads_per_process"] * config_["queue_length_scale_factor"],
         abort_event=abort,
     )
     thread_p = mp.pool.ThreadPool(
         processes=config_["scan_max_threads_per_process"],
         initializer=threadworker,
-        initargs=((thread_q, innershutdown, abort)),
+        initargs=((thread_q, folder_lock, abort)),
     )
-    while (not shutdown.is_set()) and (not abort.is_set()):
+    # Documents from several directories are sent to elasticsearch together.
+    elastic_batch_size = config_.get("elastic_batch_size", 128)
+    docs: list[str] = []
+    while not abort.is_set():
         try:
-            (
-                dirpath,
-                dirnames,
-                filenames,
-                walk_items,
-                aggregate_subdirs,
-                start_timestamp,
-                scan_id,
-            ) = inqueue.get(timeout=10)
-        except queue_.Empty:
-            continue
+            to_scan = inqueue.get()
         except OSError:
             abort.set()
             break
+        if to_scan is None:
+            inqueue.task_done()
+            break
 
         try:
-            folder = models.File(dirpath, start_timestamp, scan_id)
+            for item in to_scan:
+                if abort.is_set():
+                    break
+                batch = scan_directory(item, thread_q, folder_lock, abort)
+                # Serialize here, so the elastic worker isn't left to do it for every process.
+                docs.extend(map(elastic.dumps_source, batch))
+                if len(docs) >= elastic_batch_size:
+                    outqueue.put(docs)
+                    docs = []
         except OSError:
             abort.set()
             break
-
-        if walk_items:
-            for file in filenames:
-                filepath = os.path.join(dirpath, file)
-                outqueue.put(models.File(filepath, start_timestamp, scan_id).to_dict(True))
-        else:
-            for file in filenames:
-                filepath = os.path.join(dirpath, file)
-                thread_q.put((folder, filepath))
-
-        if aggregate_subdirs:
-            for dir_ in dirnames:
-                # Because we vendor the os module, it's type hints do not get picked up by mypy.
-                for idirpath, _, ifilenames in vos.walk(os.path.join(dirpath, dir_)):  # type: ignore[no-untyped-call]
-                    thread_q.put((folder, idirpath))
-                    for file in ifilenames:
-                        thread_q.put(
-                            (
-                                folder,
-                                os.path.join(idirpath, file),
-                            )
-                        )
-
-        thread_q.join()
-        outqueue.put(folder.to_dict(True))
         inqueue.task_done()
 
     # Cleanup tasks.
     thread_q.join()
+    # Send the last, partial, batch.
+    if docs:
+        outqueue.put(docs)
 
-    innershutdown.set()
+    # Tell each thread to exit once it has finished what is already queued.
+    for _ in range(config_["scan_max_threads_per_process"]):
+        thread_q.put(None)
     thread_p.close()
     thread_p.join()
 
     del thread_q
 
 
+def scan_directory(
+    to_scan: ToScan,
+    thread_q: queue_.Queue[typing.Optional[ThreadTask]],
+    folder_lock: th.Lock,
+    abort: th.Event,
+) -> list[dict[str, typing.Any]]:
+    """Scan a directory from the walk, and return the documents for everything found in it.
+
+    A directory which has gone since it was listed is skipped. Raises OSError for any
+    other error reading the directory itself.
+    """
+    (
+        dirpath,
+        dirnames,
+        filenames,
+        walk_items,
+        aggregate_subdirs,
+        start_timestamp,
+        scan_id,
+    ) = to_scan
+    try:
+        folder_stat = statx.fast_lstat(dirpath)
+    except (FileNotFoundError, PermissionError) as err:
+        # The directory has gone, or been locked down, since it was listed.
+        warnings.warn(errors.FileNotFoundWarning(err))
+        return []
+    folder = models.File(dirpath, start_timestamp, scan_id, folder_stat)
+
+    # Everything found in this directory goes to elasticsearch in one put.
+    batch = []
+    if walk_items:
+        for file in filenames:
+            filepath = os.path.join(dirpath, file)
+            try:
+                stat_ = statx.fast_lstat(filepath)
+            except (FileNotFoundError, PermissionError) as err:
+                warnings.warn(errors.FileNotFoundWarning(err))
+                continue
+            batch.append(models.build_file_doc(filepath, stat_, start_timestamp, scan_id))
+    elif len(filenames) <= _THREAD_CHUNK_SIZE and not (aggregate_subdirs and dirnames):
+        # Most directories are small, and handing a single chunk to a thread
+        # would only add a round trip through the queue.
+        filepaths = [os.path.join(dirpath, file) for file in filenames]
+        incorporate_chunk(folder, filepaths, folder_lock, abort)
+    else:
+        filepaths_it = (os.path.join(dirpath, file) for file in filenames)
+        for chunk in _chunks(filepaths_it, _THREAD_CHUNK_SIZE):
+            thread_q.put((folder, chunk))
+
+    if aggregate_subdirs:
+        for dir_ in dirnames:
+            subdir = os.path.join(dirpath, dir_)
+            subtree = itertools.chain([subdir], scandir_tree(subdir))
+            for chunk in _chunks(subtree, _THREAD_CHUNK_SIZE):
+                thread_q.put((folder, chunk))
+
+    thread_q.join()
+    batch.append(models.fast_to_dict(folder))
+    return batch
+
+
+def _chunks(items: typing.Iterable[str], size: int) -> typing.Iterator[list[str]]:
+    """Split items into lists of up to size items."""
+    iterator = iter(items)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+
+
+def scandir_tree(path: str) -> typing.Iterator[str]:
+    """Yield the path of everything below a path, without following symlinks.
+
+    Unlike walking with os.walk, this doesn't stat each directory to check it isn't a
+    symlink, the type from the directory listing is enough.
+    Directories which can't be read are skipped, as os.walk does.
+    """
+    try:
+        scandir_it = os.scandir(path)
+    except OSError:
+        return
+    with scandir_it:
+        while True:
+            try:
+                entry = next(scandir_it)
+            except StopIteration:
+                break
+            except OSError:
+                return
+            yield entry.path
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+            except OSError:
+                is_dir = False
+            if is_dir:
+                yield from scandir_tree(entry.path)
+
+
 def threadworker(
-    thread_q: queue_.Queue[tuple[models.File, str]],
-    shutdown: th.Event,
+    thread_q: queue_.Queue[typing.Optional[ThreadTask]],
+    folder_lock: th.Lock,
     abort: th.Event,
 ) -> None:
-    """Worker to aggredate subdirectories into a Folder object."""
-    while (not shutdown.is_set()) and (not abort.is_set()):
-        try:
-            folder, path = thread_q.get(timeout=10)
-        except queue_.Empty:
-            continue
+    """Worker to aggredate subdirectories into a Folder object.
+
+    Runs until it gets None from the queue. After an abort, the rest of the queue is
+    drained without doing any work, so the worker is never blocked putting to it.
+    """
+    while True:
+        task = thread_q.get()
+        if task is None:
+            thread_q.task_done()
+            break
+        if not abort.is_set():
+            folder, paths = task
+            incorporate_chunk(folder, paths, folder_lock, abort)
+        thread_q.task_done()
+
+
+def incorporate_chunk(
+    folder: models.File,
+    paths: typing.Sequence[str],
+    folder_lock: th.Lock,
+    abort: th.Event,
+) -> None:
+    """Stat a chunk of paths and aggregate them into a folder.
+
+    The stats are done without the lock, so threads can do them in parallel.
+    """
+    stats = []
+    for path in paths:
         try:
-            folder.incorporate_child(path)
+            stats.append((path, statx.fast_lstat(path)))
+        except (FileNotFoundError, PermissionError) as err:
+            warnings.warn(errors.FileNotFoundWarning(err))
         except OSError:
             abort.set()
-
-        thread_q.task_done()
+            break
+    with folder_lock:
+        folder.incorporate_children(stats)
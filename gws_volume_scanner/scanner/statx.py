@@ -0,0 +1,134 @@
+"""Stat files without forcing networked filesystems to sync their metadata."""
+import ctypes
+import errno
+import os
+import sys
+import typing
+
+# Constants from linux/fcntl.h and linux/stat.h.
+AT_FDCWD = -100
+AT_SYMLINK_NOFOLLOW = 0x100
+AT_STATX_DONT_SYNC = 0x4000
+STATX_BASIC_STATS = 0x7FF
+
+
+class _StatxTimestamp(ctypes.Structure):
+    # pylint: disable=too-few-public-methods
+    _fields_ = [
+        ("tv_sec", ctypes.c_int64),
+        ("tv_nsec", ctypes.c_uint32),
+        ("_reserved", ctypes.c_int32),
+    ]
+
+
+class _Statx(ctypes.Structure):
+    # pylint: disable=too-few-public-methods
+    _fields_ = [
+        ("stx_mask", ctypes.c_uint32),
+        ("stx_blksize", ctypes.c_uint32),
+        ("stx_attributes", ctypes.c_uint64),
+        ("stx_nlink", ctypes.c_uint32),
+        ("stx_uid", ctypes.c_uint32),
+        ("stx_gid", ctypes.c_uint32),
+        ("stx_mode", ctypes.c_uint16),
+        ("_spare0", ctypes.c_uint16),
+        ("stx_ino", ctypes.c_uint64),
+        ("stx_size", ctypes.c_uint64),
+        ("stx_blocks", ctypes.c_uint64),
+        ("stx_attributes_mask", ctypes.c_uint64),
+        ("stx_atime", _StatxTimestamp),
+        ("stx_btime", _StatxTimestamp),
+        ("stx_ctime", _StatxTimestamp),
+        ("stx_mtime", _StatxTimestamp),
+        ("stx_rdev_major", ctypes.c_uint32),
+        ("stx_rdev_minor", ctypes.c_uint32),
+        ("stx_dev_major", ctypes.c_uint32),
+        ("stx_dev_minor", ctypes.c_uint32),
+        ("_spare2", ctypes.c_uint64 * 14),
+    ]
+
+
+def _load_statx() -> typing.Optional[typing.Any]:
+    """Find the statx wrapper in libc, which glibc has had since 2.28."""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        statx_ = ctypes.CDLL(None, use_errno=True).statx
+    except AttributeError:
+        return None
+    statx_.argtypes = [
+        ctypes.c_int,
+        ctypes.c_char_p,
+        ctypes.c_int,
+        ctypes.c_uint,
+        ctypes.POINTER(_Statx),
+    ]
+    statx_.restype = ctypes.c_int
+    return statx_
+
+
+_statx = _load_statx()
+
+
+def _timestamp(stx_time: _StatxTimestamp) -> tuple[float, int]:
+    return (
+        stx_time.tv_sec + stx_time.tv_nsec / 1e9,
+        stx_time.tv_sec * 1_000_000_000 + stx_time.tv_nsec,
+    )
+
+
+def fast_lstat(path: str) -> os.stat_result:
+    """Like os.lstat, but allow the filesystem to answer from cached metadata.
+
+    On Lustre and NFS a plain stat asks the server for up to date attributes, which
+    is much slower and not needed for scanning. Falls back to os.lstat where statx
+    isn't available.
+    """
+    global _statx  # pylint: disable=global-statement
+    if _statx is None:
+        return os.lstat(path)
+
+    buf = _Statx()
+    ret = _statx(
+        AT_FDCWD,
+        os.fsencode(path),
+        AT_SYMLINK_NOFOLLOW | AT_STATX_DONT_SYNC,
+        STATX_BASIC_STATS,
+        ctypes.byref(buf),
+    )
+    if ret != 0:
+        err = ctypes.get_errno()
+        if err in (errno.ENOSYS, errno.EPERM):
+            # The kernel (or a seccomp filter) doesn't allow statx, don't try again.
+            _statx = None
+            return os.lstat(path)
+        raise OSError(err, os.strerror(err), path)
+
+    atime, atime_ns = _timestamp(buf.stx_atime)
+    mtime, mtime_ns = _timestamp(buf.stx_mtime)
+    ctime, ctime_ns = _timestamp(buf.stx_ctime)
+    return os.stat_result(
+        (
+            buf.stx_mode,
+            buf.stx_ino,
+            os.makedev(buf.stx_dev_major, buf.stx_dev_minor),
+            buf.stx_nlink,
+            buf.stx_uid,
+            buf.stx_gid,
+            buf.stx_size,
+            int(atime),
+            int(mtime),
+            int(ctime),
+        ),
+        {
+            "st_atime": atime,
+            "st_mtime": mtime,
+            "st_ctime": ctime,
+            "st_atime_ns": atime_ns,
+            "st_mtime_ns": mtime_ns,
+            "st_ctime_ns": ctime_ns,
+            "st_blksize": buf.stx_blksize,
+            "st_blocks": buf.stx_blocks,
+            "st_rdev": os.makedev(buf.stx_rdev_major, buf.stx_rdev_minor),
+        },
+    )
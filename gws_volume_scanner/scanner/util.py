@@ -1,3 +1,4 @@
+import ctypes
 import logging
 import logging.config
 import logging.handlers
@@ -10,10 +11,51 @@ import threading as th
 import typing
 
 from .. import constants
-from . import config, elastic, errors, models, scanner
+from . import config, elastic, errors, scanner
 
 T = typing.TypeVar("T")
 
+# Modules imported once by the forkserver, rather than by every scan process.
+_SCAN_PRELOAD = [
+    "gws_volume_scanner.scanner.scanner",
+    "gws_volume_scanner.scanner.elastic",
+    "gws_volume_scanner.scanner.models",
+]
+
+
+def scan_context() -> multiprocessing.context.ForkServerContext:
+    """Return the multiprocessing context scan processes are started from.
+
+    Scan processes are forked from a forkserver, rather than from the daemon, so they
+    don't each get a copy of its heap. Anything shared with them, such as queues and
+    events, must be created from this context.
+    """
+    ctx = mp.get_context("forkserver")
+    ctx.set_forkserver_preload(_SCAN_PRELOAD)
+    return ctx
+
+
+class AbortEvent(multiprocessing.synchronize.Event):
+    """A multiprocessing Event which also wakes up anything waiting on given conditions.
+
+    This lets a queue's join() wait for its tasks or an abort without polling.
+    Conditions must be added before the event is passed to other processes.
+    """
+
+    def __init__(self, *, ctx: typing.Optional[multiprocessing.context.BaseContext] = None):
+        super().__init__(ctx=ctx or mp.get_context())
+        self._notify: list[multiprocessing.synchronize.Condition] = []
+
+    def notify_on_set(self, cond: multiprocessing.synchronize.Condition) -> None:
+        """Notify all waiters on cond whenever the event is set."""
+        self._notify.append(cond)
+
+    def set(self) -> None:
+        super().set()
+        for cond in self._notify:
+            with cond:
+                cond.notify_all()
+
 
 class CancellableQueue(queue_.Queue[T]):
     """Create a cancellable Queue."""
@@ -21,6 +63,14 @@ class CancellableQueue(queue_.Queue[T]):
     def __init__(self, maxsize: int = 0, *, abort_event: th.Event):
         self.abort_event = abort_event
         super().__init__(maxsize=maxsize)
+        # The abort event may be set by another process, so it can't notify join()
+        # itself. A thread waits for it instead, for as long as the process runs.
+        th.Thread(target=self._notify_on_abort, daemon=True).start()
+
+    def _notify_on_abort(self) -> None:
+        self.abort_event.wait()
+        with self.all_tasks_done:
+            self.all_tasks_done.notify_all()
 
     def join(self) -> None:
         """Override logic from queue join method.
@@ -30,25 +80,79 @@ class CancellableQueue(queue_.Queue[T]):
         but allows the queue to exit when signalled with an error.
         """
         with self.all_tasks_done:
-            while self.unfinished_tasks:
-                if self.abort_event.is_set():
-                    return
-                self.all_tasks_done.wait(5)
+            self.all_tasks_done.wait_for(
+                lambda: not self.unfinished_tasks or self.abort_event.is_set()
+            )
 
 
-# The type of this should be multiprocessing.queues.JoinableQueue[T] but that breaks at runtime.
-class CancellableJoinableQueue(multiprocessing.queues.JoinableQueue):  # type: ignore[type-arg]
-    """Create a cancellable multiprocessing Queue."""
+# The type of this should be multiprocessing.queues.Queue[T] but that breaks at runtime.
+class CancellableJoinableQueue(multiprocessing.queues.Queue):  # type: ignore[type-arg]
+    """Create a cancellable, joinable multiprocessing Queue.
+
+    This is built on a plain Queue rather than JoinableQueue. Unfinished tasks are
+    counted in shared memory, guarded by a single condition, rather than with
+    JoinableQueue's semaphore and condition, so no semaphore is created which would
+    never be used.
+
+    Nothing here waits with a timeout or polls: task_done() and setting the abort event
+    both notify the condition, so waits are untimed and locks are taken with a plain
+    acquire, which doesn't release the GIL unless the lock is contended.
+    """
 
     def __init__(
         self,
         maxsize: int = 0,
         *,
         ctx: multiprocessing.context.BaseContext,
-        abort_event: multiprocessing.synchronize.Event,
+        abort_event: typing.Optional[AbortEvent] = None,
     ):
-        self.abort_event = abort_event
+        # Without an abort event, join() only returns once every task is done.
+        self.abort_event = abort_event or AbortEvent(ctx=ctx)
         super().__init__(maxsize=maxsize, ctx=ctx)
+        self._cond = ctx.Condition()
+        self._pending = ctx.RawValue(ctypes.c_int64, 0)
+        # Setting the event wakes up join(), even from another process.
+        self.abort_event.notify_on_set(self._cond)
+
+    # The state is extended with the condition, the task count and the abort event.
+    def __getstate__(self) -> typing.Any:
+        return super().__getstate__() + (  # type: ignore[operator]
+            self._cond,
+            self._pending,
+            self.abort_event,
+        )
+
+    def __setstate__(self, state: typing.Any) -> None:
+        super().__setstate__(state[:-3])
+        self._cond, self._pending, self.abort_event = state[-3:]
+
+    def put(
+        self, obj: typing.Any, block: bool = True, timeout: typing.Optional[float] = None
+    ) -> None:
+        """Follows the same logic as JoinableQueue.put, but counts the task in _pending."""
+        if self._closed:  # type: ignore[attr-defined]
+            raise ValueError(f"Queue {self!r} is closed")
+        if not self._sem.acquire(block, timeout):  # type: ignore[attr-defined]
+            raise queue_.Full
+
+        with self._notempty, self._cond:  # type: ignore[attr-defined]
+            if self._thread is None:  # type: ignore[attr-defined]
+                self._start_thread()  # type: ignore[attr-defined]
+            self._buffer.append(obj)  # type: ignore[attr-defined]
+            self._pending.value += 1
+            self._notempty.notify()  # type: ignore[attr-defined]
+
+    def task_done(self, n: int = 1) -> None:
+        """Mark n tasks as done, waking join() when there are none left.
+
+        Consumers which take several items at once can mark them all done together.
+        """
+        with self._cond:
+            if self._pending.value < n:
+                raise ValueError("task_done() called too many times")
+            self._pending.value -= n
+            if self._pending.value == 0:
+                self._cond.notify_all()
 
     def join(self) -> None:
         """Override logic from multiprocessing queue join method.
@@ -57,104 +161,165 @@ class CancellableJoinableQueue(multiprocessing.queues.JoinableQueue):  # type: i
         https://github.com/python/cpython/blob/main/Lib/multiprocessing/queues.py#L330
         but allows the queue to exit when signalled with an error.
         """
-        # This errors probably relate to the whole class not being typed properly
-        with self._cond:  # type: ignore[attr-defined]
-            while not self._unfinished_tasks._semlock._is_zero():  # type: ignore[attr-defined]
-                if self.abort_event.is_set():
-                    return
-                self._cond.wait(5)  # type: ignore[attr-defined]
+        with self._cond:
+            self._cond.wait_for(lambda: not self._pending.value or self.abort_event.is_set())
+
+    @property
+    def pending(self) -> int:
+        """The number of tasks which have been put but not marked as done.
+
+        This is read without the lock, so it may be out of date by the time it is used.
+        """
+        return int(self._pending.value)
 
 
 class ElasticQueueWorker:
-    """Create and manage a worker for sending files to es."""
+    """Create and manage workers for sending files to es."""
 
     def __init__(self, config_: config.ScannerSchema):
+        # Workers are started from the forkserver too, so they don't inherit the daemon's
+        # threads and connections.
+        ctx = scan_context()
+
         # Used to signal to the worker to exit.
-        self._shutdown = mp.Event()
-        self._abort = mp.Event()
+        self._shutdown = ctx.Event()
 
         # Setup queue of items for elasticsearch.
-        self.queue: mp.JoinableQueue[models.File] = mp.JoinableQueue(
-            config_["queue_length_scale_factor"]
+        # Each item is a list of serialized documents, so they are pickled and signalled in
+        # batches, and pickling them is just copying strings.
+        # It holds about queue_length_scale_factor documents, though a batch can run over
+        # elastic_batch_size by the documents of one directory.
+        # Scan processes put to the queue, so it is created from their context.
+        self.queue = CancellableJoinableQueue(
+            max(1, config_["queue_length_scale_factor"] // config_.get("elastic_batch_size", 128)),
+            ctx=ctx,
         )
 
-        # Start process to to elastic tasks.
-        self._pr = mp.Process(
-            target=elastic.worker,
-            args=((self.queue, config_, self._shutdown)),
-        )
-        self._pr.start()
+        # Start processes to do elastic tasks. They all take from the same queue, documents
+        # have no ids so the order they are indexed in doesn't matter.
+        self._prs = [
+            ctx.Process(
+                target=elastic.worker,
+                args=((self.queue, config_, self._shutdown)),
+            )
+            for _ in range(config_.get("elastic_workers", 1))
+        ]
+        for pr in self._prs:
+            pr.start()
 
     def shutdown(self) -> None:
-        """Shutdown queue and worker and make sure everything gets tidied up."""
+        """Shutdown queue and workers and make sure everything gets tidied up."""
         # Ensure queue is done.
         self.queue.close()
         self.queue.join()
 
-        # Signal to worker it should finish.
+        # Signal to workers they should finish.
         self._shutdown.set()
 
-        # Shut the process down.
-        self._pr.join()
-        self._pr.close()
+        # Shut the processes down.
+        for pr in self._prs:
+            pr.join()
+            pr.close()
 
         # Shutdown queue completely.
         self.queue.join_thread()
 
 
 class ScanQueueWorker:
-    """Create and mannage queue and worker pool for scanning files."""
+    """Create and mannage queues and worker processes for scanning files.
+
+    Each worker has its own queue, and items are put on the queue of the least
+    busy worker. Directories vary wildly in how long they take to scan, so a
+    worker stuck on a large one isn't given more to do while the others are idle.
+    """
 
     def __init__(
         self,
         config_: config.ScannerSchema,
-        elastic_q: queue_.Queue[models.File],
-        abort: multiprocessing.synchronize.Event,
+        elastic_q: CancellableJoinableQueue,
+        abort: AbortEvent,
     ):
-        # Used to signal to the worker to exit.
-        self._shutdown = mp.Event()
-        self._abort = abort
+        # Setup a queue of items for each worker.
+        ctx = scan_context()
 
-        # Setup queue of items for the scanner.
-        ctx = mp.get_context()
-        self.queue: mp.JoinableQueue[scanner.ToScan] = CancellableJoinableQueue(
-            config_["scan_processes"] * config_["queue_length_scale_factor"],
-            abort_event=self._abort,
-            ctx=ctx,
-        )
+        self._abort = abort
+        # Each item is a list of directories, all those listed by the walk at once.
+        # None tells the worker to exit, so it can block on its queue without polling.
+        self._worker_queues = [
+            CancellableJoinableQueue(
+                config_["queue_length_scale_factor"],
+                abort_event=self._abort,
+                ctx=ctx,
+            )
+            for _ in range(config_["scan_processes"])
+        ]
+
+        # A worker process for each queue.
+        self._processes = [
+            ctx.Process(
+                target=scanner.worker,
+                args=((queue, elastic_q, config_, self._abort)),
+                daemon=True,
+            )
+            for queue in self._worker_queues
+        ]
+        for proc in self._processes:
+            proc.start()
+
+    def put(
+        self,
+        to_scan: "list[scanner.ToScan]",
+        block: bool = True,
+        timeout: typing.Optional[float] = None,
+    ) -> None:
+        """Put items on the queue of the worker with the fewest unfinished tasks.
 
-        # Pool of workers to deal with the queue.
-        self._pl = mp.Pool(  # pylint: disable=consider-using-with
-            processes=config_["scan_processes"],
-            initializer=scanner.worker,
-            initargs=((self.queue, elastic_q, config_, self._shutdown, self._abort)),
-        )
+        Raises queue.Full if that queue is still full after timeout.
+        """
+        queue = min(self._worker_queues, key=lambda queue: queue.pending)
+        queue.put(to_scan, block, timeout)
 
     def shutdown(self) -> None:
-        """Shutdown queue and worker pool and make sure everything gets tidied up."""
-        # Ensure queue is done.
-        self.queue.close()
-        self.queue.join()
-
-        # Signal to worker it should finish.
-        self._shutdown.set()
-
-        # Ensure pool is done.
-        # The order of these is different to if you are using a worker.
-        self._pl.close()
-        self._pl.join()
-
-        # Shutdown queue completely.
-        self.queue.join_thread()
+        """Shutdown queues and workers and make sure everything gets tidied up."""
+        # Ensure the queues are done.
+        for queue in self._worker_queues:
+            queue.join()
+
+        # Signal to the workers they should finish.
+        for queue in self._worker_queues:
+            try:
+                queue.put(None, block=False)
+            except queue_.Full:
+                # Only after an abort, when the worker exits without emptying its queue.
+                pass
+            queue.close()
+            # After an abort, whatever is left in the queue will never be read.
+            if self._abort.is_set():
+                queue.cancel_join_thread()
+        for proc in self._processes:
+            proc.join()
+
+        # Shutdown queues completely.
+        for queue in self._worker_queues:
+            queue.join_thread()
 
 
 class QueueLogger:
     def __init__(self, name: typing.Optional[str] = None, *, log_config: dict[str, typing.Any]):
         log_config = constants.DEFAULT_LOGGING_CONFIG | log_config
-        self.queue: queue_.Queue[typing.Any] = mp.Queue()
+        # These aren't part of the dictConfig schema.
+        queue_limit = log_config.pop("queue_limit", 25000)
+        overflow_policy = log_config.pop("overflow_policy", "block")
+        # Handlers which should only pass notifications can then have a level of "NOTIFY".
+        logging.addLevelName(100, "NOTIFY")
+        # Everything which logs through the queue runs in this process, scan processes log
+        # directly. So records don't need to be pickled and sent through a pipe.
+        self.queue: OverflowQueue[typing.Any] = OverflowQueue(
+            queue_limit, overflow_policy=overflow_policy
+        )
         logging.config.dictConfig(log_config)
         logger = logging.getLogger()
-        self.listener = logging.handlers.QueueListener(self.queue, *logger.handlers)
+        self.listener = DropReportingListener(self.queue, *logger.handlers)
         self.listener.start()
 
     def shutdown(self) -> None:
@@ -164,16 +329,114 @@ class QueueLogger:
 def getLogger(
     name: typing.Optional[str] = None, *, queue: queue_.Queue[typing.Any]
 ) -> logging.Logger:
-    """Return a logger which will pass all items up to a QueueHandler."""
-    queue_handler = logging.handlers.QueueHandler(queue)
+    """Return a logger which will pass all items up to a QueueHandler.
+
+    This can be called for the same logger many times, eg. once per scan, and it will
+    only ever have one handler for the queue.
+    """
     logger = logging.getLogger(name)
     logger.propagate = False
-    logger.addHandler(queue_handler)
+    if not any(
+        isinstance(handler, logging.handlers.QueueHandler) and handler.queue is queue
+        for handler in logger.handlers
+    ):
+        logger.addHandler(FastQueueHandler(queue))
     return logger
 
 
+class FastQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler for a queue which is read in the same process.
+
+    The records don't need to be pickled, so they are not copied or formatted here,
+    the listener's handlers format them. The message is still merged with its
+    arguments, in case they change before the listener gets to the record.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class OverflowQueue(queue_.Queue[T]):
+    """A bounded queue which can drop items, rather than block, when it is full.
+
+    put_nowait, which QueueHandler uses, follows overflow_policy:
+    "block" waits for space, "drop_newest" drops the item being put and
+    "drop_oldest" drops the item at the front of the queue to make room.
+    Dropped items are counted in dropped.
+    """
+
+    OVERFLOW_POLICIES = ("block", "drop_newest", "drop_oldest")
+
+    def __init__(self, maxsize: int = 0, *, overflow_policy: str = "block"):
+        if overflow_policy not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow_policy: {overflow_policy}")
+        super().__init__(maxsize)
+        self.overflow_policy = overflow_policy
+        self.dropped = 0
+
+    def put_nowait(self, item: T) -> None:
+        # None is the listener's sentinel to stop, so it is never dropped.
+        if self.overflow_policy == "block" or item is None:
+            self.put(item)
+            return
+        with self.not_full:
+            if 0 < self.maxsize <= self._qsize():
+                self.dropped += 1
+                if self.overflow_policy == "drop_newest":
+                    return
+                # The new item takes over the unfinished task of the one dropped.
+                self._get()
+            else:
+                self.unfinished_tasks += 1
+            self._put(item)
+            self.not_empty.notify()
+
+
+class DropReportingListener(logging.handlers.QueueListener):
+    """QueueListener which reports records dropped by an OverflowQueue.
+
+    A NOTIFY record is handled every report_interval drops, so it isn't lost
+    to the full queue itself. Handler levels are respected, as they would be if
+    the handlers were on the logger.
+    """
+
+    def __init__(
+        self,
+        queue: OverflowQueue[typing.Any],
+        *handlers: logging.Handler,
+        report_interval: int = 10000,
+    ):
+        super().__init__(queue, *handlers, respect_handler_level=True)
+        self._overflow_queue = queue
+        self.report_interval = report_interval
+        self._reported = 0
+
+    def handle(self, record: logging.LogRecord) -> None:
+        super().handle(record)
+        dropped = self._overflow_queue.dropped
+        if dropped - self._reported >= self.report_interval:
+            self._reported = dropped
+            super().handle(
+                logging.makeLogRecord(
+                    {
+                        "name": __name__,
+                        "levelno": 100,
+                        "levelname": logging.getLevelName(100),
+                        "msg": "%s log records have been dropped as the log queue was full.",
+                        "args": (dropped,),
+                    }
+                )
+            )
+
+
 class FilterNotify(logging.Filter):
-    """Log filter to filter only records where level==100"""
+    """Log filter to filter only records where level==100
+
+    Kept for existing logging configs. Setting the handler's level to "NOTIFY" does the
+    same, and the level is checked without calling a filter for every record.
+    """
 
     def filter(self, record: logging.LogRecord) -> bool:
         if record.levelno == 100:
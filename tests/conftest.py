@@ -1,5 +1,6 @@
 """Test configuration and global fixtures."""
 # nosec
+import concurrent.futures
 import mimetypes
 import os
 import pathlib
@@ -14,13 +15,28 @@ def name(length: int = 12) -> str:
     return "".join(random.choice(string.ascii_lowercase) for i in range(length))
 
 
+def allocate(filename: pathlib.Path, size: int) -> None:
+    # Allocate the blocks without writing them, du counts allocated blocks.
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        os.posix_fallocate(fd, 0, size)
+    finally:
+        os.close(fd)
+
+
 def create_subtree(
     path: pathlib.Path,
+    executor: concurrent.futures.Executor,
     level: int = 0,
     count: int = 10,
     max_level: int = 5,
     max_size: int = 5**8,
 ) -> typing.Tuple[typing.Set[pathlib.Path], typing.Set[pathlib.Path]]:
+    """Create a random tree of directories and files.
+
+    Files are created by the executor, while the rest of the tree is walked.
+    """
+    futures = []
     files = set()
     folders = set()
     for _ in range(count):
@@ -37,6 +53,7 @@ def create_subtree(
             filename.mkdir()
             nestedfolders, nestedfiles = create_subtree(
                 path / foldername,
+                executor,
                 level=level + 1,
                 count=count,
                 max_level=max_level,
@@ -48,9 +65,11 @@ def create_subtree(
             # File of type.
             extension = random.choice(list(mimetypes.types_map.keys()))
             filename = path / (foldername + extension)
-            with open(filename, "wb") as thefile:
-                thefile.write(os.urandom(random.randint(1, max_size)))
+            futures.append(executor.submit(allocate, filename, random.randint(1, max_size)))
             files.add(filename)
+    # Raise any errors from creating the files.
+    for future in futures:
+        future.result()
     return (folders, files)
 
 
@@ -63,5 +82,7 @@ def file_tree(
 ) -> FileTestTreeInfo:
     """Create and populate a fake file tree to scan."""
     path = tmp_path_factory.mktemp("filetree")
-    folder, file = create_subtree(path)
+    # Creating files is bound by syscalls, so it's done by threads.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=32) as executor:
+        folder, file = create_subtree(path, executor)
     return (path, folder, file)
@@ -0,0 +1,109 @@
+"""Tests which check configuration files are validated against their schemas."""
+import pathlib
+
+import pytest
+
+from gws_volume_scanner.scanner import config, errors
+
+EXAMPLE_CONFIG = (pathlib.Path(__file__).parent.parent / "config.example.toml").read_text()
+
+
+def load(tmp_path: pathlib.Path, text: str) -> config.ScannerConfig:
+    """Write a main config file and load it."""
+    path = tmp_path / "config.toml"
+    path.write_text(text)
+    return config.ScannerConfig(str(path))
+
+
+def test_example_config_is_valid(tmp_path: pathlib.Path) -> None:
+    """Check the example config loads."""
+    loaded = load(tmp_path, EXAMPLE_CONFIG)
+    assert loaded.scanner["scan_processes"] == 2
+    assert loaded.scanner["elastic"]["hosts"] == ["127.0.0.1"]
+
+
+@pytest.mark.parametrize(
+    "line",
+    [
+        "scan_processes = 2\n",
+        "fail_threshold = 5\n",
+        "timeout = 60\n",
+    ],
+)
+def test_missing_required_key(tmp_path: pathlib.Path, line: str) -> None:
+    """Check a config missing a required key, at any depth, is rejected."""
+    with pytest.raises(errors.ScannerMainConfigError):
+        load(tmp_path, EXAMPLE_CONFIG.replace(line, ""))
+
+
+@pytest.mark.parametrize(
+    ("line", "replacement"),
+    [
+        ("scan_processes = 2", 'scan_processes = "2"'),
+        ("use_ssl = false", "use_ssl = 0"),
+        ("never_scan = []", "never_scan = [1]"),
+        ("logging_config = {}", "logging_config = []"),
+        ("scan_depth = 5", "scan_depth = [5]"),
+    ],
+)
+def test_wrong_type(tmp_path: pathlib.Path, line: str, replacement: str) -> None:
+    """Check a config with a value of the wrong type is rejected."""
+    assert line in EXAMPLE_CONFIG
+    with pytest.raises(errors.ScannerMainConfigError):
+        load(tmp_path, EXAMPLE_CONFIG.replace(line, replacement))
+
+
+@pytest.mark.parametrize(
+    "line",
+    [
+        "scan_processes = 2\n",
+        "timeout = 60\n",
+        "scan_depth = 10\n",
+    ],
+)
+def test_unknown_key(tmp_path: pathlib.Path, line: str) -> None:
+    """Check a config with a misspelt key is rejected."""
+    with pytest.raises(errors.ScannerMainConfigError):
+        load(tmp_path, EXAMPLE_CONFIG.replace(line, line + "x" + line))
+
+
+def test_not_required_keys(tmp_path: pathlib.Path) -> None:
+    """Check the optional keys can be left out."""
+    text = EXAMPLE_CONFIG
+    for line in (
+        "scan_walker_threads = 8\n",
+        "elastic_batch_size = 128\n",
+        "elastic_workers = 1\n",
+        "bulk_thread_count = 4\n",
+        "bulk_queue_size = 8\n",
+        "bulk_chunk_size = 1000\n",
+        "bulk_max_chunk_bytes = 52428800\n",
+        "gws_list_ttl_seconds = 300\n",
+    ):
+        assert line in text
+        text = text.replace(line, "")
+    loaded = load(tmp_path, text)
+    assert "elastic_batch_size" not in loaded.scanner
+    assert "bulk_thread_count" not in loaded.scanner["elastic"]
+
+
+def test_gws_config(tmp_path: pathlib.Path) -> None:
+    """Check a GWS's own config is validated, then limited by the overrides."""
+    loaded = load(tmp_path, EXAMPLE_CONFIG)
+    gws = tmp_path / "gws"
+    gws.mkdir()
+    gws_config = gws / ".gws-scanner-config.toml"
+
+    gws_config.write_text("scan_depth = 20\naggregate_subdir_names = ['.venv']\n")
+    result = loaded.gws_config(str(gws))
+    assert result["scan_depth"] == 10
+    assert result["aggregate_subdir_names"][0] == ".venv"
+    assert "node_modules" in result["aggregate_subdir_names"]
+
+    gws_config.write_text('scan_depth = "deep"\n')
+    with pytest.raises(errors.ScannerGWSConfigError):
+        loaded.gws_config(str(gws))
+
+    gws_config.write_text("scan_dept = 2\n")
+    with pytest.raises(errors.ScannerGWSConfigError):
+        loaded.gws_config(str(gws))
@@ -0,0 +1,131 @@
+"""Tests which check how documents are serialized and sent to elasticsearch."""
+import collections
+import logging
+import multiprocessing as mp
+import queue as queue_
+import threading
+import typing
+
+import elasticsearch.helpers as esh
+import elasticsearch_dsl as esd
+import orjson
+import pytest
+
+from gws_volume_scanner.scanner import config, elastic
+
+CONFIG = typing.cast(
+    config.ScannerSchema,
+    {
+        "queue_length_scale_factor": 10,
+        "scan_max_threads_per_process": 1,
+        "elastic": {"data_index_name": "index"},
+    },
+)
+
+
+class BatchQueue:
+    """Hands out batches of documents, then sets shutdown once they have all been taken.
+
+    Nothing waits on an empty queue, so the worker sends what it has straight away.
+    """
+
+    def __init__(self, batches: list[list[str]], shutdown: threading.Event):
+        self.batches = collections.deque(batches)
+        self.shutdown = shutdown
+        self.done = 0
+
+    def get(self, timeout: typing.Optional[float] = None) -> list[str]:
+        if not self.batches:
+            self.shutdown.set()
+        return self.get_nowait()
+
+    def get_nowait(self) -> list[str]:
+        if not self.batches:
+            raise queue_.Empty
+        return self.batches.popleft()
+
+    def task_done(self, n: int = 1) -> None:
+        self.done += n
+
+
+class FakeBulk:
+    """Stands in for parallel_bulk, answering each request with the next list of statuses."""
+
+    def __init__(self, statuses: list[list[int]]):
+        self.statuses = statuses
+        self.requests: list[list[str]] = []
+
+    def __call__(
+        self, client: typing.Any, actions: list[str], **kwargs: typing.Any
+    ) -> typing.Iterator[tuple[bool, dict[str, typing.Any]]]:
+        statuses = self.statuses[min(len(self.requests), len(self.statuses) - 1)]
+        self.requests.append(list(actions))
+        for status in statuses:
+            yield status < 300, {"index": {"status": status}}
+
+
+@pytest.fixture(name="sleeps")
+def fixture_sleeps(monkeypatch: pytest.MonkeyPatch) -> list[float]:
+    """Don't connect to elasticsearch or sleep, but record how long the worker would sleep."""
+    sleeps: list[float] = []
+    monkeypatch.setattr(elastic, "get_connection", lambda *args: None)
+    monkeypatch.setattr(esd.connections, "get_connection", lambda *args: None)
+    monkeypatch.setattr(elastic.time, "sleep", sleeps.append)
+    # The worker names its process, which is this one.
+    monkeypatch.setattr(mp.current_process(), "name", mp.current_process().name)
+    return sleeps
+
+
+def run_worker(
+    monkeypatch: pytest.MonkeyPatch, batches: list[list[str]], bulk: FakeBulk
+) -> BatchQueue:
+    """Run the worker until it has sent everything it was given."""
+    monkeypatch.setattr(esh, "parallel_bulk", bulk)
+    shutdown = threading.Event()
+    inqueue = BatchQueue(batches, shutdown)
+    elastic.worker(inqueue, CONFIG, shutdown)  # type: ignore[arg-type]
+    assert inqueue.done == len(batches)
+    return inqueue
+
+
+def test_busy_retried(
+    monkeypatch: pytest.MonkeyPatch, sleeps: list[float], caplog: pytest.LogCaptureFixture
+) -> None:
+    """Check a document rejected as busy is sent again, after a wait."""
+    bulk = FakeBulk([[200, 429, 200], [200]])
+    run_worker(monkeypatch, [["a", "b"], ["c"]], bulk)
+    assert bulk.requests == [["a", "b", "c"], ["b"]]
+    assert sleeps == [2]
+    assert not [record for record in caplog.records if record.levelno >= logging.ERROR]
+
+
+def test_busy_dropped(
+    monkeypatch: pytest.MonkeyPatch, sleeps: list[float], caplog: pytest.LogCaptureFixture
+) -> None:
+    """Check documents still rejected as busy after the retry limit are dropped."""
+    bulk = FakeBulk([[429, 429]])
+    run_worker(monkeypatch, [["a", "b"]], bulk)
+    assert bulk.requests == [["a", "b"]] * 4
+    assert sleeps == [2, 4, 8]
+    assert "still busy after 3 retries" in caplog.text
+
+
+def test_error_not_retried(
+    monkeypatch: pytest.MonkeyPatch, sleeps: list[float], caplog: pytest.LogCaptureFixture
+) -> None:
+    """Check a document rejected for any other reason is logged and not sent again."""
+    bulk = FakeBulk([[200, 400]])
+    run_worker(monkeypatch, [["a"], ["b"]], bulk)
+    assert bulk.requests == [["a", "b"]]
+    assert not sleeps
+    assert "Failed to index 1 of 2 documents." in caplog.text
+
+
+def test_serialize_dsl_objects() -> None:
+    """Check elasticsearch-dsl's wrappers and documents can be serialized."""
+    inner = esd.AttrDict({"count": 1, "users": esd.AttrList(["a", "b"])})
+    source = elastic.dumps_source({"_source": {"inner": inner, "doc": esd.Document(path="/a")}})
+    assert orjson.loads(source) == {
+        "inner": {"count": 1, "users": ["a", "b"]},
+        "doc": {"path": "/a"},
+    }
@@ -0,0 +1,65 @@
+"""Tests which check the queries sent to elasticsearch, and how their responses are read."""
+import typing
+
+import elasticsearch_dsl as esd
+import pytest
+
+from gws_volume_scanner.client import queries
+
+
+def hit(id_: str, path: str, status: str) -> dict[str, typing.Any]:
+    """A search hit for a scan."""
+    return {"_id": id_, "_source": {"path": path, "status": status}}
+
+
+@pytest.fixture(name="searches")
+def fixture_searches(monkeypatch: pytest.MonkeyPatch) -> list[dict[str, typing.Any]]:
+    """Record searches instead of executing them, and answer with two scanned paths."""
+    searches = []
+    response = {
+        "hits": {"total": {"value": 3, "relation": "eq"}, "hits": []},
+        "aggregations": {
+            "by_path": {
+                "buckets": [
+                    {
+                        "key": "/gws/a",
+                        "doc_count": 2,
+                        "latest": {"hits": {"hits": [hit("scan-a", "/gws/a", "complete")]}},
+                    },
+                    {
+                        "key": "/gws/b",
+                        "doc_count": 1,
+                        "latest": {"hits": {"hits": [hit("scan-b", "/gws/b", "in_progress")]}},
+                    },
+                ]
+            }
+        },
+    }
+
+    def execute(self: esd.Search, ignore_cache: bool = False) -> esd.response.Response:
+        searches.append(self.to_dict())
+        return esd.response.Response(self, response)
+
+    monkeypatch.setattr(esd.Search, "execute", execute)
+    return searches
+
+
+def test_latest_scan_info_bulk(searches: list[dict[str, typing.Any]]) -> None:
+    """Check every path is asked for in one search, and missing paths are left out."""
+    results = queries.latest_scan_info_bulk(["/gws/a", "/gws/b", "/gws/c"], "index")
+
+    assert len(searches) == 1
+    assert searches[0]["query"]["bool"]["filter"] == [
+        {"terms": {"path": ["/gws/a", "/gws/b", "/gws/c"]}}
+    ]
+    assert searches[0]["aggs"]["by_path"]["terms"]["size"] == 3
+    assert results == {
+        "/gws/a": {"path": "/gws/a", "status": "complete", "id": "scan-a"},
+        "/gws/b": {"path": "/gws/b", "status": "in_progress", "id": "scan-b"},
+    }
+
+
+def test_latest_scan_info_bulk_no_paths(searches: list[dict[str, typing.Any]]) -> None:
+    """Check no search is made for no paths."""
+    assert not queries.latest_scan_info_bulk([], "index")
+    assert not searches
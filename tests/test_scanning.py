@@ -1,23 +1,35 @@
 """Tests which check the scanner results are the same as those on disk."""
 import datetime as dt
+import json
 import os
 import pathlib
 import random
 import subprocess as sp
+import threading
+import typing
 
-from gws_volume_scanner.scanner import models
+import pytest
+
+from gws_volume_scanner.scanner import config, errors, models, scanner, util
 
 from . import conftest
 
 
 def simple_path_walk(path: pathlib.Path) -> models.File:
-    """Do a simple walk incorporating all children of a path into the object."""
+    """Do a simple walk incorporating all children of a path into the object.
+
+    Each directory's children are incorporated together, using the stats from scandir.
+    """
     fileobj = models.File(str(path), dt.datetime.now(), "test_scan_id")
-    for dirpath, dirnames, filenames in os.walk(path):
-        for dir_ in dirnames:
-            fileobj.incorporate_child(os.path.join(path, dirpath, dir_))
-        for file in filenames:
-            fileobj.incorporate_child(os.path.join(path, dirpath, file))
+    stack = [str(path)]
+    while stack:
+        with os.scandir(stack.pop()) as scandir_it:
+            children = []
+            for entry in scandir_it:
+                children.append((entry.path, entry.stat(follow_symlinks=False)))
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+        fileobj.incorporate_children(children)
     return fileobj
 
 
@@ -47,3 +59,99 @@ def test_whole_tree_count(file_tree: conftest.FileTestTreeInfo) -> None:
     )
     fileobj = simple_path_walk(path)
     assert fileobj.count == findresult
+
+
+def test_vanished_file_is_empty(tmp_path: pathlib.Path) -> None:
+    """Check a file which can't be stat'd is empty, and doesn't share its bins with others."""
+    with pytest.warns(errors.FileNotFoundWarning):
+        fileobj = models.File(str(tmp_path / "gone"), dt.datetime.now(), "test_scan_id")
+    fileobj.incorporate_children([(str(tmp_path), os.lstat(tmp_path))])
+    assert fileobj.count == 1
+    assert models.fast_to_dict(fileobj)["_source"]["filetypes"] == {
+        "__directory__": {"count": 1, "size": os.lstat(tmp_path).st_blocks * 512}
+    }
+    assert models.File._filetypes_count == {}  # pylint: disable=protected-access
+
+
+def scanner_config(
+    tmp_path: pathlib.Path, gws: pathlib.Path, scan_depth: int
+) -> config.ScannerConfig:
+    """Load the example config, with a small queue and scan_depth set for one GWS."""
+    text = (pathlib.Path(__file__).parent.parent / "config.example.toml").read_text()
+    text = text.replace("queue_length_scale_factor = 1000", "queue_length_scale_factor = 10")
+    text += f'\n[gws.configs."{gws}"]\nscan_depth = {scan_depth}\n'
+    path = tmp_path / "config.toml"
+    path.write_text(text)
+    return config.ScannerConfig(str(path))
+
+
+@pytest.mark.parametrize("scan_depth", [1, 3])
+def test_queuescan(
+    file_tree: conftest.FileTestTreeInfo, tmp_path: pathlib.Path, scan_depth: int
+) -> None:
+    """Walk the tree with the scan workers and check the documents add up to the whole tree.
+
+    There should be a document for each directory which is not aggregated into its parent.
+    """
+    path = file_tree[0]
+    config_ = scanner_config(tmp_path, path, scan_depth)
+    ctx = util.scan_context()
+    elastic_q = util.CancellableJoinableQueue(ctx=ctx)
+    abort = util.AbortEvent(ctx=ctx)
+
+    # The queue is drained while the scan runs, so the workers can flush it and exit.
+    docs: list[dict[str, typing.Any]] = []
+
+    def drain() -> None:
+        while (batch := elastic_q.get()) is not None:
+            docs.extend(json.loads(doc) for doc in batch)
+            elastic_q.task_done()
+
+    drainer = threading.Thread(target=drain)
+    drainer.start()
+    scanner_q = util.ScanQueueWorker(config_.scanner, elastic_q, abort)
+    scanner.queuescan(str(path), scanner_q, config_, dt.datetime.now(), "test_scan_id", abort)
+    scanner_q.shutdown()
+    elastic_q.put(None)
+    drainer.join()
+    assert not abort.is_set()
+
+    # The top of the walk and its subdirectories are both at depth 1.
+    expected = {str(path)} | {
+        str(folder)
+        for folder in file_tree[1]
+        if max(len(folder.relative_to(path).parts) - 1, 1) < scan_depth
+    }
+    paths = [doc["path"] for doc in docs]
+    assert len(paths) == len(expected)
+    assert set(paths) == expected
+
+    duresult = int(
+        sp.run(["du", "-B1", "-s", path], capture_output=True, check=True).stdout.split()[0]
+    )
+    findresult = len(
+        sp.run(["find", path, "-print"], capture_output=True, check=True).stdout.splitlines()
+    )
+    assert sum(doc["size"] for doc in docs) == duresult
+    assert sum(doc["count"] for doc in docs) == findresult
+
+
+def test_scan_queue_worker_abort(tmp_path: pathlib.Path) -> None:
+    """Check shutdown returns after an abort, leaving work in the workers' queues."""
+    config_ = scanner_config(tmp_path, tmp_path, 1)
+    ctx = util.scan_context()
+    elastic_q = util.CancellableJoinableQueue(ctx=ctx)
+    abort = util.AbortEvent(ctx=ctx)
+    scanner_q = util.ScanQueueWorker(config_.scanner, elastic_q, abort)
+    abort.set()
+    # Fill the queues, the workers stop reading them once the scan is aborted.
+    item: list[scanner.ToScan] = [
+        (str(tmp_path), [], [], False, False, dt.datetime.now(), "test_scan_id")
+    ]
+    for _ in range(config_.scanner["scan_processes"] * 10):
+        scanner_q.put(item, block=False)
+
+    shutdown = threading.Thread(target=scanner_q.shutdown, daemon=True)
+    shutdown.start()
+    shutdown.join(30)
+    assert not shutdown.is_alive()
@@ -0,0 +1,60 @@
+"""Tests which check fast_lstat gives the same results as os.lstat."""
+import os
+import pathlib
+
+import pytest
+
+from gws_volume_scanner.scanner import statx
+
+FIELDS = (
+    "st_mode",
+    "st_ino",
+    "st_dev",
+    "st_nlink",
+    "st_uid",
+    "st_gid",
+    "st_size",
+    "st_atime",
+    "st_mtime",
+    "st_ctime",
+    "st_atime_ns",
+    "st_mtime_ns",
+    "st_ctime_ns",
+    "st_blksize",
+    "st_blocks",
+    "st_rdev",
+)
+
+
+@pytest.fixture(name="paths")
+def fixture_paths(tmp_path: pathlib.Path) -> list[pathlib.Path]:
+    """Create one of each kind of file which the scanner commonly finds."""
+    folder = tmp_path / "folder"
+    folder.mkdir()
+    file = folder / "file.txt"
+    file.write_bytes(b"x" * 10000)
+    link = tmp_path / "link"
+    link.symlink_to(file)
+    return [tmp_path, folder, file, link, pathlib.Path("/dev/null")]
+
+
+def test_fields_match_lstat(paths: list[pathlib.Path]) -> None:
+    """Check every field of the stat result is mapped from statx."""
+    for path in paths:
+        expected = os.lstat(path)
+        result = statx.fast_lstat(str(path))
+        for field in FIELDS:
+            assert getattr(result, field) == getattr(expected, field), (path, field)
+        assert tuple(result) == tuple(expected)
+
+
+def test_missing_file() -> None:
+    """Check a missing file raises the same error as os.lstat."""
+    with pytest.raises(FileNotFoundError):
+        statx.fast_lstat("/this/path/does/not/exist")
+
+
+def test_fallback(monkeypatch: pytest.MonkeyPatch, paths: list[pathlib.Path]) -> None:
+    """Check os.lstat is used when statx isn't available."""
+    monkeypatch.setattr(statx, "_statx", None)
+    assert statx.fast_lstat(str(paths[2])) == os.lstat(paths[2])
@@ -0,0 +1,139 @@
+"""Tests which check the behaviour of the queues in util."""
+import threading
+
+import pytest
+
+from gws_volume_scanner.scanner import util
+
+
+def drain(queue: util.OverflowQueue[int]) -> list[int]:
+    """Get every item from a queue, marking them done."""
+    items = []
+    while not queue.empty():
+        items.append(queue.get_nowait())
+        queue.task_done()
+    return items
+
+
+def test_drop_newest() -> None:
+    """Check items put on a full queue are dropped."""
+    queue: util.OverflowQueue[int] = util.OverflowQueue(3, overflow_policy="drop_newest")
+    for i in range(5):
+        queue.put_nowait(i)
+    assert queue.dropped == 2
+    assert drain(queue) == [0, 1, 2]
+    assert queue.unfinished_tasks == 0
+
+
+def test_drop_oldest() -> None:
+    """Check the front of a full queue is dropped to make room."""
+    queue: util.OverflowQueue[int] = util.OverflowQueue(3, overflow_policy="drop_oldest")
+    for i in range(5):
+        queue.put_nowait(i)
+    assert queue.dropped == 2
+    assert drain(queue) == [2, 3, 4]
+    assert queue.unfinished_tasks == 0
+
+
+def test_block() -> None:
+    """Check put_nowait waits for space on a full queue when blocking."""
+    queue: util.OverflowQueue[int] = util.OverflowQueue(1)
+    queue.put_nowait(0)
+    putter = threading.Thread(target=queue.put_nowait, args=(1,))
+    putter.start()
+    putter.join(0.1)
+    assert putter.is_alive()
+    assert queue.get_nowait() == 0
+    putter.join(5)
+    assert not putter.is_alive()
+    assert queue.dropped == 0
+    assert queue.get_nowait() == 1
+
+
+@pytest.mark.parametrize("policy", ["drop_newest", "drop_oldest"])
+def test_sentinel_is_never_dropped(policy: str) -> None:
+    """Check the listener's None sentinel waits for space instead of being dropped."""
+    queue: util.OverflowQueue[int | None] = util.OverflowQueue(1, overflow_policy=policy)
+    queue.put_nowait(0)
+    putter = threading.Thread(target=queue.put_nowait, args=(None,))
+    putter.start()
+    putter.join(0.1)
+    assert putter.is_alive()
+    assert queue.get_nowait() == 0
+    putter.join(5)
+    assert queue.get_nowait() is None
+    assert queue.dropped == 0
+
+
+def test_unknown_policy() -> None:
+    """Check an unknown overflow policy is rejected."""
+    with pytest.raises(ValueError):
+        util.OverflowQueue(1, overflow_policy="drop_all")
+
+
+def join_finished(queue: util.CancellableJoinableQueue, timeout: float = 10) -> bool:
+    """Join a queue in a thread, so a test fails rather than hangs if it never returns."""
+    joiner = threading.Thread(target=queue.join, daemon=True)
+    joiner.start()
+    joiner.join(timeout)
+    return not joiner.is_alive()
+
+
+def consume(queue: util.CancellableJoinableQueue) -> None:
+    """Take the three items put by the test, then put and take two more, in batches."""
+    items = [queue.get() for _ in range(3)]
+    for item in items[:2]:
+        queue.put(item * 10)
+    queue.task_done(3)
+    queue.get()
+    queue.get()
+    queue.task_done(2)
+
+
+def test_joinable_queue_across_processes() -> None:
+    """Check tasks put and marked done in a forkserver process are counted by join()."""
+    ctx = util.scan_context()
+    queue = util.CancellableJoinableQueue(ctx=ctx)
+    for i in range(3):
+        queue.put(i)
+    assert queue.pending == 3
+    assert not join_finished(queue, timeout=0.1)
+
+    process = ctx.Process(target=consume, args=(queue,))
+    process.start()
+    assert join_finished(queue)
+    process.join()
+    assert process.exitcode == 0
+    assert queue.pending == 0
+
+
+def test_task_done_too_many_times() -> None:
+    """Check marking more tasks done than were put is an error."""
+    queue = util.CancellableJoinableQueue(ctx=util.scan_context())
+    queue.put(0)
+    queue.put(1)
+    with pytest.raises(ValueError):
+        queue.task_done(3)
+    queue.task_done(2)
+    with pytest.raises(ValueError):
+        queue.task_done()
+    assert queue.pending == 0
+
+
+def test_abort_wakes_join() -> None:
+    """Check setting the abort event in another process wakes a blocked join()."""
+    ctx = util.scan_context()
+    abort = util.AbortEvent(ctx=ctx)
+    queue = util.CancellableJoinableQueue(ctx=ctx, abort_event=abort)
+    queue.put(0)
+    joiner = threading.Thread(target=queue.join, daemon=True)
+    joiner.start()
+    joiner.join(0.1)
+    assert joiner.is_alive()
+
+    process = ctx.Process(target=abort.set)
+    process.start()
+    process.join()
+    joiner.join(10)
+    assert not joiner.is_alive()
+    assert queue.pending == 1